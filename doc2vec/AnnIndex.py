@@ -0,0 +1,178 @@
+import os
+
+import numpy as np
+
+import Quantize
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores, k):
+    '''Indices of the k highest scores of each row, best first'''
+    k = min(k, scores.shape[-1])
+    top = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=-1), axis=-1)
+    return np.take_along_axis(top, order, axis=-1)
+
+
+class AnnIndex:
+    '''Inverted-file (IVF) approximate nearest neighbour index over document vectors
+    Vectors are normalized, so scores are cosine similarities. A spherical k-means splits
+    them in nlist lists; a query only scores the vectors of the nprobe lists whose centroid
+    is the closest. Vectors are stored sorted by list, so each list is one contiguous slice
+    and a saved index can be memory-mapped and queried without being loaded.
+
+    Example:
+    index = AnnIndex.from_model(model)
+    index.save('article.ann')
+    index = AnnIndex.load('article.ann')
+    ids, scores = index.search(query_vectors, k=10, nprobe=8)
+    '''
+
+    def __init__(self, centroids, vectors, ids, offsets, scale=None):
+        '''
+        [in] centroids: (nlist, dim) normalized centroids
+        [in] vectors: (n, dim) normalized vectors, sorted by list. float32, float16 or int8 codes
+        [in] ids: (n,) int64 ids of the vectors
+        [in] offsets: (nlist + 1,) start of each list in vectors
+        [in] scale: per-dimension scale of int8 vectors, see Quantize.quantize
+        '''
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, vectors, ids=None, nlist=None, iterations=10, sample_size=100000, seed=0,
+              dtype='float32'):
+        '''Build an index
+        [in] vectors: (n, dim) matrix of document vectors, e.g. DocEmb output
+        [in] ids: (n,) integer ids of the vectors. Default is the row numbers
+        [in] nlist: number of lists. Default is about 4 * sqrt(n)
+        [in] iterations: number of k-means iterations
+        [in] sample_size: number of vectors the k-means is trained on
+        [in] seed: random seed of the k-means
+        [in] dtype: storage type of the vectors, 'float32', 'float16' or 'int8'
+        '''
+        vectors = _normalize(vectors)
+        n = len(vectors)
+        ids = np.arange(n, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        nlist = min(n, nlist or max(1, int(4 * np.sqrt(n))))
+
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, size=min(n, max(sample_size, nlist)), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = cls._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=nlist) == 0
+            # restart empty lists on random sample vectors
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = _normalize(sums)
+
+        assignment = cls._assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=nlist))
+        codes, scale = Quantize.quantize(vectors[order], dtype)
+        return cls(centroids, codes, ids[order], offsets, scale)
+
+    @classmethod
+    def from_model(cls, model, **build_options):
+        '''Build an index over the document vectors of a trained Doc2Vec model
+        The ids are the positions of the documents in model.dv, see model.dv.index_to_key.
+        [in] model: trained Doc2Vec model
+        [in] build_options: options of build, e.g. nlist
+        '''
+        return cls.build(model.dv.vectors, **build_options)
+
+    @staticmethod
+    def _assign(vectors, centroids, batch_size=65536):
+        '''Closest centroid of each vector'''
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            assignment[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+        return assignment
+
+    #
+    # ==================== save / load ====================
+    #
+    def save(self, path):
+        '''Save the index to a directory of .npy files
+        [in] path: directory, created if needed
+        '''
+        os.makedirs(path, exist_ok=True)
+        for name in ['centroids', 'vectors', 'ids', 'offsets']:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        if self.scale is not None:
+            np.save(os.path.join(path, 'scale.npy'), self.scale)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''Load an index saved with save
+        [in] path: directory of the index
+        [in] mmap: memory-map the arrays read-only instead of reading them
+        '''
+        mmap_mode = 'r' if mmap else None
+        scale_path = os.path.join(path, 'scale.npy')
+        scale = np.load(scale_path) if os.path.exists(scale_path) else None
+        return cls(*(np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+                     for name in ['centroids', 'vectors', 'ids', 'offsets']), scale=scale)
+
+    #
+    # ==================== search ====================
+    #
+    def search(self, queries, k=10, nprobe=8):
+        '''Approximate top-k search
+        [in] queries: (m, dim) matrix of query vectors, or a single vector
+        [in] k: number of neighbours per query
+        [in] nprobe: number of lists scanned per query. Higher is more accurate and slower
+        [ret] ( ids, scores ): (m, k) arrays, best first. Rows with fewer than k candidates
+              are padded with id -1 and score -inf
+        '''
+        queries = np.atleast_2d(_normalize(queries))
+        probes = _top_k(queries @ self.centroids.T, nprobe)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            rows = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1]) for p in probes[i]])
+            if len(rows) == 0:
+                continue
+            candidate_scores = Quantize.scores(self.vectors[rows], self.scale, query)
+            top = _top_k(candidate_scores, k)
+            ids[i, :len(top)] = self.ids[rows[top]]
+            scores[i, :len(top)] = candidate_scores[top]
+        return (ids, scores)
+
+    def exact_search(self, queries, k=10, batch_size=1024):
+        '''Exact top-k search over all the vectors, e.g. to measure the recall of search
+        [ret] ( ids, scores ), see search
+        '''
+        queries = np.atleast_2d(_normalize(queries))
+        ids = np.empty((len(queries), min(k, len(self))), dtype=np.int64)
+        scores = np.empty(ids.shape, dtype=np.float32)
+        for start in range(0, len(queries), batch_size):
+            batch_scores = Quantize.scores(self.vectors, self.scale, queries[start:start + batch_size].T).T
+            top = _top_k(batch_scores, k)
+            ids[start:start + batch_size] = self.ids[top]
+            scores[start:start + batch_size] = np.take_along_axis(batch_scores, top, axis=1)
+        return (ids, scores)
+
+
+def recall_at_k(found, expected):
+    '''Fraction of the expected neighbours that were found
+    [in] found: (m, k) ids returned by an approximate search
+    [in] expected: (m, k) ids returned by the exact search
+    '''
+    hits = sum(len(np.intersect1d(f, e)) for f, e in zip(found, expected))
+    return hits / expected.size
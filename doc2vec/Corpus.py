@@ -0,0 +1,151 @@
+from array import array
+import json
+import os
+
+import numpy as np
+from gensim.models.doc2vec import TaggedDocument
+
+
+class CompactCorpus:
+    '''Tokenized corpus stored on disk as integer token ids
+    The token ids of all documents are one memory-mapped int32 array, with an offsets index
+    giving the start of each document, so the corpus never has to fit in memory. Iterating
+    yields TaggedDocument(words, [doc_id]) and can be repeated, e.g. once per training epoch.
+    Subsets and shuffles are views over document indices sharing the same arrays.
+
+    Example:
+    CompactCorpus.build('imdb_corpus', ((doc.words, {'split': doc.split}) for doc in docs))
+    corpus = CompactCorpus('imdb_corpus')
+    train = corpus.subset(corpus.meta('split') == 'train')
+    model.train(train.shuffled(), total_examples=len(train), epochs=model.epochs)
+    '''
+
+    def __init__(self, path, indices=None, shuffle=False, seed=None):
+        '''Open a corpus written by build
+        [in] path: directory of the corpus
+        [in] indices: document indices of the view. Default is all documents, in order
+        [in] shuffle: iterate in a new random order on each pass
+        [in] seed: random seed of the shuffles
+        '''
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.info = json.load(f)
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        n_tokens = int(self.offsets[-1])
+        self.tokens = np.memmap(os.path.join(path, 'tokens.i32'), dtype=np.int32, mode='r',
+                                shape=(n_tokens,)) if n_tokens > 0 else np.empty(0, dtype=np.int32)
+        with open(os.path.join(path, 'vocab.txt'), encoding='utf-8') as f:
+            self.vocab = np.array([line.rstrip('\n') for line in f], dtype=object)
+        self.indices = np.arange(len(self.offsets) - 1) if indices is None else np.asarray(indices)
+        self.shuffle = shuffle
+        self._rng = np.random.default_rng(seed)
+
+    def _view(self, indices, shuffle, seed=None):
+        view = CompactCorpus.__new__(CompactCorpus)
+        view.__dict__.update(self.__dict__)
+        view.indices = indices
+        view.shuffle = shuffle
+        view._rng = np.random.default_rng(seed)
+        return view
+
+    #
+    # ==================== build ====================
+    #
+    @staticmethod
+    def build(path, docs):
+        '''Tokenize-once: write a corpus to disk in a single pass
+        [in] path: directory of the corpus, created if needed
+        [in] docs: iterable of ( tokens, meta ), meta being a dict of per-document values,
+             e.g. {'split': 'train', 'sentiment': 1.0}. String values are stored as
+             categories, other values as float64 (None as NaN)
+        [ret] number of documents written
+        '''
+        os.makedirs(path, exist_ok=True)
+        vocab = {}
+        offsets = array('q', [0])
+        meta = {}
+        categories = {}
+        with open(os.path.join(path, 'tokens.i32'), 'wb') as f:
+            for tokens, values in docs:
+                ids = array('i', [vocab.setdefault(token, len(vocab)) for token in tokens])
+                ids.tofile(f)
+                offsets.append(offsets[-1] + len(ids))
+                for field, value in values.items():
+                    if field not in meta:
+                        # documents written before the field first appears have no value
+                        if isinstance(value, str):
+                            meta[field] = array('i', [-1] * (len(offsets) - 2))
+                            categories[field] = {}
+                        else:
+                            meta[field] = array('d', [float('nan')] * (len(offsets) - 2))
+                    if field in categories:
+                        meta[field].append(-1 if value is None else
+                                           categories[field].setdefault(value, len(categories[field])))
+                    else:
+                        meta[field].append(float('nan') if value is None else float(value))
+                for field in meta.keys() - values.keys():
+                    meta[field].append(-1 if field in categories else float('nan'))
+
+        np.save(os.path.join(path, 'offsets.npy'), np.frombuffer(offsets, dtype=np.int64))
+        with open(os.path.join(path, 'vocab.txt'), 'w', encoding='utf-8') as f:
+            f.write(''.join(token + '\n' for token in vocab))
+        for field, values in meta.items():
+            np.save(os.path.join(path, f'meta_{field}.npy'),
+                    np.frombuffer(values, dtype=np.int32 if field in categories else np.float64))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'n_docs': len(offsets) - 1, 'n_tokens': offsets[-1], 'fields': list(meta),
+                       'categories': {field: list(values) for field, values in categories.items()}}, f)
+        return len(offsets) - 1
+
+    #
+    # ==================== views ====================
+    #
+    def subset(self, selection):
+        '''View of some documents of this view
+        [in] selection: boolean mask over the documents of this view, or positions in it
+        '''
+        return self._view(self.indices[np.asarray(selection)], self.shuffle)
+
+    def shuffled(self, seed=None):
+        '''View iterating the same documents in a new random order on each pass
+        [in] seed: random seed of the shuffles
+        '''
+        return self._view(self.indices, True, seed)
+
+    #
+    # ==================== access ====================
+    #
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        indices = self._rng.permutation(self.indices) if self.shuffle else self.indices
+        for index in indices:
+            yield self._document(index)
+
+    def __getitem__(self, position):
+        return self._document(self.indices[position])
+
+    def _document(self, index):
+        ids = self.tokens[self.offsets[index]:self.offsets[index + 1]]
+        return TaggedDocument(self.vocab[ids].tolist(), [int(index)])
+
+    @property
+    def tags(self):
+        '''Document tags of the view, in order'''
+        return self.indices
+
+    @property
+    def total_words(self):
+        '''Number of tokens in the view'''
+        return int((self.offsets[self.indices + 1] - self.offsets[self.indices]).sum())
+
+    def meta(self, field):
+        '''Per-document values of a meta field for the documents of the view, in order
+        [ret] numpy array: strings for categories (None if missing), float64 otherwise (NaN if missing)
+        '''
+        values = np.load(os.path.join(self.path, f'meta_{field}.npy'), mmap_mode='r')[self.indices]
+        if field in self.info['categories']:
+            # code -1, a missing value, picks the trailing None
+            return np.array(self.info['categories'][field] + [None], dtype=object)[values]
+        return values
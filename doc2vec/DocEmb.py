@@ -1,9 +1,113 @@
+from collections import deque
+import itertools
+import multiprocessing
+import os
+
+import numpy as np
 from gensim.test.utils import common_texts
 from gensim.models.doc2vec import Doc2Vec, TaggedDocument
 
+import ModelStore
+
+# Model of a worker process of DocEmb.embed_batch, set by _init_worker
+_worker_model = None
+
+
+def _init_worker(model, model_path=None):
+    global _worker_model
+    if model is None:
+        _worker_model, _ = ModelStore.load_model(model_path, mmap='r')
+    else:
+        _worker_model = model
+
+
+def _embed_chunk(docs):
+    return _embed(_worker_model, docs)
+
+
+def _embed(model, docs):
+    '''Infer the vectors of a list of tokenized documents into a float32 matrix'''
+    vectors = np.empty((len(docs), model.vector_size), dtype=np.float32)
+    for i, doc in enumerate(docs):
+        vectors[i] = model.infer_vector(doc)
+    return vectors
+
+
 class DocEmb:
-    def __init__(self, model):
+    def __init__(self, model, model_path=None):
         self.model = model
+        self.model_path = model_path
+
+    @classmethod
+    def from_file(cls, path, mmap='r'):
+        '''Load a model saved with ModelStore.save_model, memory-mapped read-only by default
+        Serving processes loading the same file share one copy of the weights.
+        [in] path: path of the model file
+        [in] mmap: 'r' to memory-map the arrays, None to read them in memory
+        '''
+        model, _ = ModelStore.load_model(path, mmap=mmap)
+        return cls(model, model_path=path)
 
     def __call__(self, doc):
-        return self.model.infer_vector(doc)
\ No newline at end of file
+        return self.model.infer_vector(doc)
+
+    def embed_many(self, docs):
+        '''Embed a list of tokenized documents in the current process
+        [in] docs: list of token lists
+        [ret] float32 matrix of shape (len(docs), vector_size)
+        '''
+        return _embed(self.model, docs)
+
+    def pool(self, workers=None):
+        '''Start a pool of worker processes for embed_batch, e.g. to reuse it across many calls
+        Workers are forked after the model is loaded, so they share its memory pages instead
+        of each receiving a copy. Where fork is not available, workers memory-map the model
+        file if the model was loaded with from_file.
+        [in] workers: number of worker processes. Default is the number of cores
+        [ret] multiprocessing Pool, to close when done
+        '''
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            initargs = (self.model,)
+        elif self.model_path is not None:
+            context = multiprocessing.get_context()
+            initargs = (None, self.model_path)
+        else:
+            # without fork nor model file, the model is pickled once to each worker
+            context = multiprocessing.get_context()
+            initargs = (self.model,)
+        return context.Pool(workers or os.cpu_count(), initializer=_init_worker, initargs=initargs)
+
+    def embed_batch(self, docs, chunk_size=1024, workers=None, pool=None):
+        '''Embed many tokenized documents on a pool of worker processes
+        At most two chunks per worker are queued, so any iterable, e.g. a generator over a
+        whole corpus, can be streamed.
+        [in] docs: iterable of token lists
+        [in] chunk_size: number of documents per chunk
+        [in] workers: number of worker processes. Default is the number of cores
+        [in] pool: pool started with pool(), left open. Default starts a pool for this call
+        [ret] generator of float32 matrices of shape (chunk_size, vector_size), in input order.
+              The last matrix may be smaller
+        '''
+        workers = workers or os.cpu_count()
+        docs = iter(docs)
+        chunks = iter(lambda: list(itertools.islice(docs, chunk_size)), [])
+        if pool is not None:
+            yield from self._embed_chunks(pool, chunks, workers)
+            return
+        if workers == 1:
+            for chunk in chunks:
+                yield self.embed_many(chunk)
+            return
+        with self.pool(workers) as pool:
+            yield from self._embed_chunks(pool, chunks, workers)
+
+    @staticmethod
+    def _embed_chunks(pool, chunks, workers):
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_embed_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
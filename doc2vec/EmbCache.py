@@ -0,0 +1,250 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import itertools
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def model_fingerprint(model):
+    '''Fingerprint of a Doc2Vec model, changing whenever its parameters or weights change
+    The weights are sampled (about 1024 rows per matrix) to keep this fast on large models.
+    [in] model: Doc2Vec model
+    [ret] hex string
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    params = (type(model).__name__, model.vector_size, getattr(model, 'dm', None),
+              getattr(model, 'window', None), getattr(model, 'epochs', None),
+              getattr(model, 'hs', None), getattr(model, 'negative', None),
+              getattr(model, 'corpus_count', None))
+    h.update(repr(params).encode('utf-8'))
+    for name in ['syn1neg', 'syn1']:
+        weights = getattr(model, name, None)
+        if weights is not None and len(weights) > 0:
+            h.update(np.ascontiguousarray(weights[::max(1, len(weights) // 1024)]).tobytes())
+    vectors = model.wv.vectors
+    h.update(repr(vectors.shape).encode('utf-8'))
+    h.update(np.ascontiguousarray(vectors[::max(1, len(vectors) // 1024)]).tobytes())
+    return h.hexdigest()
+
+
+class VectorStore:
+    '''Append-only on-disk vector store, read through a memory map
+    Vectors are rows of a raw float32 file, and their keys are lines of a text file in the
+    same order. A vector is written before its key, so a crash never leaves a key without
+    its vector. Writes hold an exclusive lock on the store, and first read the keys other
+    writers appended, so several processes can share one store: a vector another process
+    stored is found after the next write. Without fcntl (Windows), only one process may
+    write to a store.
+    '''
+
+    def __init__(self, path, vector_size):
+        '''
+        [in] path: directory of the store, created if needed
+        [in] vector_size: number of dimensions of the vectors
+        '''
+        os.makedirs(path, exist_ok=True)
+        self.vector_size = vector_size
+        self._vectors_path = os.path.join(path, 'vectors.f32')
+        self._keys_path = os.path.join(path, 'keys.txt')
+        self._lock_path = os.path.join(path, 'lock')
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._row_count = 0
+        self._keys_offset = 0
+        self._map = None
+        with self._lock, self._file_lock():
+            self._sync()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def get(self, key):
+        '''Get a stored vector
+        [ret] read-only float32 vector, or None if the key is not stored
+        '''
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                return None
+            if self._map is None or row >= len(self._map):
+                self._map = np.memmap(self._vectors_path, dtype=np.float32, mode='r',
+                                      shape=(self._row_count, self.vector_size))
+            return self._map[row]
+
+    def put_many(self, keys, vectors):
+        '''Append vectors to the store
+        [in] keys: list of keys
+        [in] vectors: float32 matrix, one row per key
+        '''
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock, self._file_lock():
+            self._sync()
+            new = {}
+            for i, key in enumerate(keys):
+                if key not in self._rows:
+                    new.setdefault(key, i)
+            if not new:
+                return
+            with open(self._vectors_path, 'ab') as f:
+                f.write(vectors[list(new.values())].tobytes())
+            with open(self._keys_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(key + '\n' for key in new))
+            self._sync()
+
+    @contextmanager
+    def _file_lock(self):
+        '''Exclusive lock of the store files across processes'''
+        with open(self._lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _sync(self):
+        '''Read the keys appended since the last sync, by this or another process, and drop
+        the partially written tail of a crashed writer. Called with the file lock held
+        '''
+        row_bytes = self.vector_size * 4
+        stored_rows = os.path.getsize(self._vectors_path) // row_bytes if os.path.exists(self._vectors_path) else 0
+        with open(self._keys_path, 'ab+') as f:
+            f.seek(self._keys_offset)
+            for line in f:
+                if not line.endswith(b'\n') or self._row_count >= stored_rows:
+                    break
+                self._rows.setdefault(line[:-1].decode('utf-8'), self._row_count)
+                self._row_count += 1
+                self._keys_offset += len(line)
+            f.truncate(self._keys_offset)
+        with open(self._vectors_path, 'ab') as f:
+            f.truncate(self._row_count * row_bytes)
+
+
+class CachedDocEmb:
+    '''DocEmb with an in-memory LRU cache in front of a persistent vector store
+    Vectors are keyed on a hash of the token list and of the model fingerprint, and the
+    store of each model lives in its own sub-directory, so a new model never reads the
+    vectors of another one.
+
+    Example:
+    emb = CachedDocEmb(DocEmb(model), 'emb_cache')
+    vectors = emb.embed_many(docs)
+    print(emb.stats())
+    '''
+
+    def __init__(self, doc_emb, cache_dir, max_memory_entries=100000):
+        '''
+        [in] doc_emb: DocEmb computing the vectors missing from the cache
+        [in] cache_dir: directory of the persistent stores
+        [in] max_memory_entries: number of vectors kept in memory
+        '''
+        self.doc_emb = doc_emb
+        self.fingerprint = model_fingerprint(doc_emb.model)
+        self.store = VectorStore(os.path.join(cache_dir, self.fingerprint), doc_emb.model.vector_size)
+        self.max_memory_entries = max_memory_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, doc):
+        '''Cache key of a tokenized document'''
+        h = hashlib.blake2b(self.fingerprint.encode('ascii'), digest_size=20)
+        h.update('\x1f'.join(doc).encode('utf-8'))
+        return h.hexdigest()
+
+    def __call__(self, doc):
+        return self.embed_many([doc])[0]
+
+    def pool(self, workers=None):
+        '''Start a pool of worker processes inferring the misses, see DocEmb.pool'''
+        return self.doc_emb.pool(workers)
+
+    def embed_many(self, docs, **batch_options):
+        '''Embed a list of tokenized documents, inferring only the ones not cached
+        [in] docs: list of token lists
+        [in] batch_options: options of DocEmb.embed_batch, e.g. workers, used for the misses.
+             Default infers the misses in the current process
+        [ret] float32 matrix of shape (len(docs), vector_size)
+        '''
+        keys = [self.key(doc) for doc in docs]
+        vectors = np.empty((len(docs), self.store.vector_size), dtype=np.float32)
+        missing = {}
+        for i, key in enumerate(keys):
+            vector = self._lookup(key)
+            if vector is None:
+                missing.setdefault(key, []).append(i)
+            else:
+                vectors[i] = vector
+        if not missing:
+            return vectors
+
+        missing_keys = list(missing)
+        missing_docs = [docs[missing[key][0]] for key in missing_keys]
+        if batch_options:
+            inferred = np.concatenate(list(self.doc_emb.embed_batch(missing_docs, **batch_options)))
+        else:
+            inferred = self.doc_emb.embed_many(missing_docs)
+        self.store.put_many(missing_keys, inferred)
+        for key, vector in zip(missing_keys, inferred):
+            vectors[missing[key]] = vector
+            self._remember(key, vector)
+        return vectors
+
+    def embed_batch(self, docs, chunk_size=1024, **batch_options):
+        '''Embed many tokenized documents chunk by chunk, see DocEmb.embed_batch
+        [in] docs: iterable of token lists
+        [in] chunk_size: number of documents per chunk
+        [in] batch_options: options of DocEmb.embed_batch used for the misses, e.g. workers
+        [ret] generator of float32 matrices, in input order
+        '''
+        docs = iter(docs)
+        for chunk in iter(lambda: list(itertools.islice(docs, chunk_size)), []):
+            yield self.embed_many(chunk, **batch_options)
+
+    def stats(self):
+        '''Get the cache counters
+        [ret] dict with memory hits, disk hits, misses, hit rate and number of stored vectors
+        '''
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+                'memory_entries': len(self._memory), 'stored': len(self.store)}
+
+    def _lookup(self, key):
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+        vector = self.store.get(key)
+        with self._lock:
+            if vector is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        vector = np.array(vector)
+        self._remember(key, vector)
+        return vector
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
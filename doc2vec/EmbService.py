@@ -0,0 +1,177 @@
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+
+class EmbeddingService:
+    '''Asyncio embedding service batching concurrent requests
+    Requests are queued and collected into batches of at most max_batch_size documents,
+    waiting at most max_wait_ms after the first one. Each batch is embedded with
+    DocEmb.embed_many on a worker pool. While all the workers are busy, requests keep
+    queuing, so batches grow with the load.
+
+    Example:
+    async with EmbeddingService(DocEmb(model), max_batch_size=32, max_wait_ms=5) as service:
+        vector = await service.infer(['hello', 'world'])
+        print(service.metrics())
+    '''
+
+    def __init__(self, doc_emb, max_batch_size=32, max_wait_ms=5.0, workers=None, executor=None):
+        '''
+        [in] doc_emb: DocEmb (or CachedDocEmb) used to embed the documents
+        [in] max_batch_size: maximum number of documents per batch
+        [in] max_wait_ms: maximum time the first request of a batch waits for more requests
+        [in] workers: number of batches embedded at once. Default is the number of cores
+        [in] executor: executor running the batches. Default is a thread pool of workers threads;
+             gensim releases the GIL while inferring, so threads run in parallel
+        '''
+        self.doc_emb = doc_emb
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.workers = workers or os.cpu_count()
+        self._executor = executor
+        self._own_executor = executor is None
+        self._queue = None
+        self._batcher = None
+        self._slots = None
+        self._tasks = set()
+        self._stopping = False
+
+        self.requests = 0
+        self.batches = 0
+        self.batch_sizes = Counter()
+        self._wait_total = 0.0
+        self._latency_total = 0.0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    #
+    # ==================== start / stop ====================
+    #
+    async def start(self):
+        '''Start the batching task'''
+        if self._own_executor:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._stopping = False
+        self._batcher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        '''Embed the queued requests and stop'''
+        self._stopping = True
+        # the batcher dispatches the requests queued before the sentinel, including the
+        # batch it is collecting, then ends
+        self._queue.put_nowait(None)
+        await self._batcher
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+
+    #
+    # ==================== infer ====================
+    #
+    async def infer(self, doc):
+        '''Embed one tokenized document
+        [in] doc: list of tokens
+        [ret] float32 vector
+        '''
+        if self._stopping:
+            raise RuntimeError('EmbeddingService is stopped')
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((doc, future, time.perf_counter()))
+        return await future
+
+    async def infer_many(self, docs):
+        '''Embed several tokenized documents, batched with the other requests
+        [ret] list of float32 vectors
+        '''
+        return await asyncio.gather(*(self.infer(doc) for doc in docs))
+
+    #
+    # ==================== metrics ====================
+    #
+    def metrics(self):
+        '''Get the service metrics
+        [ret] dict with the queue depth, number of batches running, number of requests and
+              batches, mean batch size, batch size histogram, mean queue wait and mean latency
+        '''
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'running_batches': len(self._tasks),
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / self.batches if self.batches > 0 else 0.0,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+            'mean_wait_ms': 1000.0 * self._wait_total / self.requests if self.requests > 0 else 0.0,
+            'mean_latency_ms': 1000.0 * self._latency_total / self.requests if self.requests > 0 else 0.0,
+        }
+
+    #
+    # ==================== _run ====================
+    #
+    async def _run(self):
+        '''Collect requests into batches and dispatch them to the workers'''
+        loop = asyncio.get_running_loop()
+        while True:
+            # wait for a free worker first, so requests accumulate while all are busy
+            await self._slots.acquire()
+            request = await self._queue.get()
+            if request is None:
+                self._slots.release()
+                return
+            batch = [request]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size and request is not None:
+                if not self._queue.empty():
+                    request = self._queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if request is not None:
+                    batch.append(request)
+
+            task = asyncio.create_task(self._embed(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            if request is None:
+                # stop() was called: no request follows the sentinel
+                return
+
+    async def _embed(self, batch):
+        '''Embed one batch and resolve the futures of its requests'''
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            vectors = await loop.run_in_executor(self._executor, self.doc_emb.embed_many,
+                                                 [doc for doc, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        end = time.perf_counter()
+        self.requests += len(batch)
+        self.batches += 1
+        self.batch_sizes[len(batch)] += 1
+        for (_, future, queued), vector in zip(batch, vectors):
+            self._wait_total += start - queued
+            self._latency_total += end - queued
+            if not future.done():
+                future.set_result(vector)
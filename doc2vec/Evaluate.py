@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+import numpy as np
+import statsmodels.api as sm
+
+from DocEmb import DocEmb
+
+
+def _indices(dv, tags):
+    '''Positions of document tags in the vector array of dv'''
+    tags = np.asarray(tags)
+    if tags.dtype.kind in 'iu':
+        # plain int tags are the positions themselves
+        return tags
+    return np.fromiter((dv.get_index(tag) for tag in tags), dtype=np.int64, count=len(tags))
+
+
+class Evaluator:
+    '''Evaluate document embedding models on a labelled train / test split
+    Each model gets a logistic regression classification error, and self-retrieval metrics:
+    the vector inferred from a test document should find the trained vector of the same document.
+    Document vectors are gathered with one fancy-index per split and cached per model, so the
+    concatenation of models (ConcatenatedDoc2Vec) only stacks the matrices of its components.
+
+    Example:
+    evaluator = Evaluator(train_docs, test_docs, label='sentiment')
+    for name, metrics in evaluator.evaluate(models_by_name).items():
+        print(name, metrics['error_rate'], metrics['recall@10'], metrics['mrr'])
+    '''
+
+    def __init__(self, train_set, test_set, label='sentiment', workers=None):
+        '''
+        [in] train_set: CompactCorpus of the documents to fit the classifier on
+        [in] test_set: CompactCorpus of the documents to evaluate on
+        [in] label: meta field of the 0 / 1 targets
+        [in] workers: number of models evaluated at once. Default is the number of cores
+        '''
+        self.sets = {'train': train_set, 'test': test_set}
+        self.targets = {split: docs.meta(label) for split, docs in self.sets.items()}
+        self.workers = workers or os.cpu_count()
+        self._cache = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    #
+    # ==================== vectors ====================
+    #
+    def vectors(self, model, split):
+        '''Get the trained vectors of the documents of a split, in order
+        [in] model: Doc2Vec or ConcatenatedDoc2Vec model
+        [in] split: 'train', 'test' or 'all' for the whole vector array
+        [ret] float32 matrix of shape (number of documents, vector_size)
+        '''
+        if hasattr(model, 'models'):
+            return np.hstack([self.vectors(component, split) for component in model.models])
+        if split == 'all':
+            return model.dv.vectors
+        return self._cached((id(model), split),
+                            lambda: model.dv.vectors[_indices(model.dv, self.sets[split].tags)])
+
+    def inferred(self, model, positions):
+        '''Get the vectors inferred from the words of test documents
+        [in] model: Doc2Vec or ConcatenatedDoc2Vec model
+        [in] positions: positions of the documents in the test split
+        [ret] float32 matrix of shape (len(positions), vector_size)
+        '''
+        if hasattr(model, 'models'):
+            return np.hstack([self.inferred(component, positions) for component in model.models])
+        docs = self.sets['test']
+        return self._cached((id(model), 'inferred', positions.tobytes()),
+                            lambda: DocEmb(model).embed_many([docs[position].words for position in positions]))
+
+    def _cached(self, key, compute):
+        '''Compute a value once, even when several threads ask for it'''
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._cache:
+                self._cache[key] = compute()
+            return self._cache[key]
+
+    #
+    # ==================== error_rate ====================
+    #
+    def error_rate(self, model):
+        '''Classification error of a logistic regression on the document vectors
+        [ret] ( error_rate, errors, number of test documents, fitted statsmodels predictor )
+        '''
+        train_regressors = sm.add_constant(self.vectors(model, 'train'), has_constant='add')
+        predictor = sm.Logit(self.targets['train'], train_regressors).fit(disp=0)
+
+        test_regressors = sm.add_constant(self.vectors(model, 'test'), has_constant='add')
+        predictions = predictor.predict(test_regressors)
+        errors = int(np.count_nonzero(np.rint(predictions) != self.targets['test']))
+        return (errors / len(predictions), errors, len(predictions), predictor)
+
+    #
+    # ==================== retrieval ====================
+    #
+    def retrieval(self, model, ks=(1, 10), sample_size=1000, seed=0, chunk_size=256):
+        '''Self-retrieval metrics on a sample of test documents
+        The vector inferred from the words of each document is ranked by cosine similarity
+        against all the trained document vectors; the hit is the trained vector of that document.
+        [in] ks: cutoffs of the recall@k metrics
+        [in] sample_size: number of test documents queried
+        [in] seed: random seed of the sample, the same for all the models
+        [in] chunk_size: number of queries scored at once
+        [ret] dict with recall@k for each k and the mean reciprocal rank (mrr)
+        '''
+        docs = self.sets['test']
+        positions = np.sort(np.random.default_rng(seed).choice(len(docs), min(sample_size, len(docs)),
+                                                               replace=False))
+        candidates = self.vectors(model, 'all')
+        candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+        queries = self.inferred(model, positions)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        hits = self.vectors(model, 'test')[positions]
+        hits = hits / np.maximum(np.linalg.norm(hits, axis=1, keepdims=True), 1e-12)
+
+        ranks = np.empty(len(positions), dtype=np.int64)
+        for start in range(0, len(positions), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            scores = queries[chunk] @ candidates.T
+            hit_scores = np.einsum('ij,ij->i', queries[chunk], hits[chunk])
+            ranks[chunk] = 1 + np.count_nonzero(scores > hit_scores[:, None], axis=1)
+
+        metrics = {f'recall@{k}': float(np.mean(ranks <= k)) for k in ks}
+        metrics['mrr'] = float(np.mean(1.0 / ranks))
+        return metrics
+
+    #
+    # ==================== evaluate ====================
+    #
+    def evaluate(self, models, **retrieval_options):
+        '''Evaluate several models in parallel
+        Threads share the cached vectors: numpy, statsmodels and gensim inference release the GIL.
+        [in] models: dict of models keyed by name
+        [in] retrieval_options: options of retrieval, e.g. ks or sample_size
+        [ret] dict keyed by model name of the error rate, number of errors and of test documents,
+              retrieval metrics and evaluation time in seconds
+        '''
+        def run(model):
+            start = time.perf_counter()
+            error_rate, errors, test_count, _ = self.error_rate(model)
+            metrics = {'error_rate': error_rate, 'errors': errors, 'test_count': test_count}
+            metrics.update(self.retrieval(model, **retrieval_options))
+            metrics['seconds'] = time.perf_counter() - start
+            return metrics
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = dict(zip(models, executor.map(run, models.values())))
+        return results
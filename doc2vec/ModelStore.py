@@ -0,0 +1,51 @@
+import resource
+import time
+
+from gensim.models.doc2vec import Doc2Vec
+
+
+def save_model(model, path):
+    '''Save a trained model so that it can be memory-mapped
+    Every array of the model is saved to its own .npy file next to path, whatever its size.
+    [in] model: trained Doc2Vec model
+    [in] path: path of the model file
+    '''
+    model.save(path, sep_limit=0)
+
+
+def load_model(path, mmap='r'):
+    '''Load a model saved with save_model
+    With mmap='r' the arrays are memory-mapped read-only: loading does not read them, and
+    all the processes mapping the same files, e.g. forked or separately started serving
+    workers, share one physical copy in the page cache. Read-only models can still infer
+    vectors, but not be trained.
+    [in] path: path of the model file
+    [in] mmap: 'r' to memory-map the arrays read-only, None to read them in memory
+    [ret] ( model, stats ) with the load time in seconds and the memory of the process
+          after loading, see memory_usage
+    '''
+    start = time.perf_counter()
+    model = Doc2Vec.load(path, mmap=mmap)
+    stats = dict(seconds=time.perf_counter() - start, **memory_usage())
+    print(f'Loaded {path} in {stats["seconds"]:.2f}s, resident memory {stats["rss_mb"]:.0f} MB '
+          f'({stats["rss_file_mb"]:.0f} MB shared file pages)')
+    return (model, stats)
+
+
+def memory_usage():
+    '''Get the resident memory of the current process
+    [ret] dict with the resident memory (rss_mb), its anonymous (private) and file-backed
+          (shared with other processes mapping the same files) parts, in MB
+    '''
+    usage = {'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+             'rss_anon_mb': 0.0, 'rss_file_mb': 0.0}
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        for name, key in [('VmRSS', 'rss_mb'), ('RssAnon', 'rss_anon_mb'), ('RssFile', 'rss_file_mb')]:
+            if name in fields:
+                usage[key] = int(fields[name].split()[0]) / 1024.0
+    except OSError:
+        # no /proc, e.g. macOS: only the peak resident memory is known
+        pass
+    return usage
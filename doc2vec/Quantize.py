@@ -0,0 +1,114 @@
+import os
+import time
+
+import numpy as np
+
+DTYPES = ['float32', 'float16', 'int8']
+
+
+def quantize(vectors, dtype='int8'):
+    '''Quantize float32 vectors
+    int8 codes use a symmetric per-dimension scale: x ~ code * scale[dim].
+    [in] vectors: (n, dim) float matrix
+    [in] dtype: 'float32', 'float16' or 'int8'
+    [ret] ( codes, scale ). scale is None for float32 and float16
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == 'float32':
+        return (vectors, None)
+    if dtype == 'float16':
+        return (vectors.astype(np.float16), None)
+    if dtype == 'int8':
+        scale = np.abs(vectors).max(axis=0) / 127.0
+        scale[scale == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scale), -127, 127).astype(np.int8)
+        return (codes, scale.astype(np.float32))
+    raise ValueError(f'Invalid dtype {dtype}, expected one of {DTYPES}')
+
+
+def dequantize(codes, scale=None):
+    '''Convert quantized vectors back to float32'''
+    vectors = np.asarray(codes, dtype=np.float32)
+    return vectors * scale if scale is not None else vectors
+
+
+def scores(codes, scale, query, block_rows=65536):
+    '''Dot products of quantized vectors with a float32 query
+    The per-dimension scale is folded into the query, so the codes are only cast, not rescaled.
+    They are cast block_rows rows at a time: scoring never holds a float32 copy of all the codes.
+    [in] codes: (n, dim) quantized vectors
+    [in] scale: per-dimension scale of int8 codes, or None
+    [in] query: (dim,) vector or (dim, m) matrix
+    [in] block_rows: number of rows cast to float32 at once
+    [ret] (n,) or (n, m) float32 scores
+    '''
+    query = np.asarray(query, dtype=np.float32)
+    if scale is not None:
+        query = query * (scale if query.ndim == 1 else scale[:, None])
+    if codes.dtype == np.float32:
+        return codes @ query
+    result = np.empty((len(codes),) + query.shape[1:], dtype=np.float32)
+    for start in range(0, len(codes), block_rows):
+        block = codes[start:start + block_rows]
+        np.matmul(block.astype(np.float32), query, out=result[start:start + len(block)])
+    return result
+
+
+def save_vectors(path, vectors, dtype='float32'):
+    '''Quantize vectors and save them to a directory of .npy files
+    [in] path: directory, created if needed
+    [in] vectors: (n, dim) float matrix
+    [in] dtype: 'float32', 'float16' or 'int8'
+    '''
+    codes, scale = quantize(vectors, dtype)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'vectors.npy'), codes)
+    if scale is not None:
+        np.save(os.path.join(path, 'scale.npy'), scale)
+
+
+def load_vectors(path, mmap=True):
+    '''Load vectors saved with save_vectors
+    [in] path: directory of the vectors
+    [in] mmap: memory-map the codes read-only instead of reading them
+    [ret] ( codes, scale ). Use dequantize or scores to read them
+    '''
+    codes = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r' if mmap else None)
+    scale_path = os.path.join(path, 'scale.npy')
+    scale = np.load(scale_path) if os.path.exists(scale_path) else None
+    return (codes, scale)
+
+
+def evaluate(vectors, queries, k=10, dtypes=DTYPES, batch_size=1024):
+    '''Compare exact top-k search on quantized vectors with float32
+    [in] vectors: (n, dim) float32 corpus vectors
+    [in] queries: (m, dim) float32 query vectors
+    [in] k: number of neighbours
+    [in] dtypes: storage types to evaluate
+    [ret] list of dicts with the dtype, memory: storage size of the codes and scale in bytes,
+          memory ratio to float32, recall@k against float32 and queries per second. Scoring
+          also needs a float32 buffer of at most block_rows rows, see scores
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+
+    def search(codes, scale):
+        found = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), batch_size):
+            batch_scores = scores(codes, scale, queries[start:start + batch_size].T).T
+            top = np.argpartition(-batch_scores, k - 1, axis=1)[:, :k]
+            found[start:start + batch_size] = top
+        return found
+
+    expected = search(vectors, None)
+    results = []
+    for dtype in dtypes:
+        codes, scale = quantize(vectors, dtype)
+        start = time.perf_counter()
+        found = search(codes, scale)
+        seconds = time.perf_counter() - start
+        recall = sum(len(np.intersect1d(f, e)) for f, e in zip(found, expected)) / expected.size
+        memory = codes.nbytes + (scale.nbytes if scale is not None else 0)
+        results.append({'dtype': dtype, 'memory': memory, 'memory_ratio': memory / vectors.nbytes,
+                        'recall': recall, 'qps': len(queries) / seconds})
+    return results
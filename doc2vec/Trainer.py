@@ -0,0 +1,156 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+from gensim.models.doc2vec import Doc2Vec
+
+from Corpus import CompactCorpus
+import ModelStore
+
+
+class TrainingOrchestrator:
+    '''Train several Doc2Vec models in parallel with per-epoch checkpoints
+    Each model trains in its own process with its own number of worker threads, and models
+    are started as long as their workers fit in the core budget. A checkpoint is saved after
+    every epoch, so an interrupted run resumes from the last finished epoch of each model.
+
+    Example:
+    orchestrator = TrainingOrchestrator('aclImdb_corpus', 'checkpoints', cores=8)
+    stats = orchestrator.run([
+        {'name': 'dbow', 'params': dict(dm=0, vector_size=100, epochs=20), 'workers': 4},
+        {'name': 'dmm', 'params': dict(dm=1, window=10, vector_size=100, epochs=20), 'workers': 4}])
+    model = orchestrator.load('dbow')
+    '''
+
+    def __init__(self, corpus_path, checkpoint_dir, cores=None):
+        '''
+        [in] corpus_path: directory of a CompactCorpus to train on
+        [in] checkpoint_dir: directory of the checkpoints and final models
+        [in] cores: number of worker threads of all the models training at once.
+             Default is the number of cores
+        '''
+        self.corpus_path = corpus_path
+        self.checkpoint_dir = checkpoint_dir
+        self.cores = cores or os.cpu_count()
+
+    #
+    # ==================== run ====================
+    #
+    def run(self, configs):
+        '''Train models, resuming the ones already started
+        [in] configs: list of dicts with a unique name, the Doc2Vec params (epochs included,
+             workers excluded) and optionally the number of workers. Default workers is an
+             even share of the cores
+        [ret] dict keyed by model name of the training state: finished epochs, and wall time,
+              corpus words and words/sec of each epoch
+        '''
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        pending = [dict(config, workers=config.get('workers') or max(1, self.cores // len(configs)))
+                   for config in configs]
+        results = {}
+        running = {}
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        with ProcessPoolExecutor(max_workers=len(configs), mp_context=context) as executor:
+            while pending or running:
+                used = sum(config['workers'] for config in running.values())
+                # start the next model if it fits the budget, or if nothing runs
+                while pending and (not running or used + pending[0]['workers'] <= self.cores):
+                    config = pending.pop(0)
+                    print(f'Starting {config["name"]} with {config["workers"]} workers')
+                    future = executor.submit(_train, self.corpus_path, self.checkpoint_dir, config)
+                    running[future] = config
+                    used += config['workers']
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    config = running.pop(future)
+                    try:
+                        results[config['name']] = future.result()
+                    except Exception as e:
+                        print(f'Error: training {config["name"]} failed: {e}')
+                        results[config['name']] = _read_state(os.path.join(self.checkpoint_dir, config['name']))
+        return {config['name']: results[config['name']] for config in configs}
+
+    #
+    # ==================== load ====================
+    #
+    def load(self, name, mmap=None):
+        '''Load a trained model
+        [in] name: name of the model
+        [in] mmap: 'r' to memory-map the arrays read-only, see ModelStore.load_model
+        '''
+        model, _ = ModelStore.load_model(os.path.join(self.checkpoint_dir, name, 'model'), mmap=mmap)
+        return model
+
+
+def _read_state(job_dir):
+    path = os.path.join(job_dir, 'state.json')
+    if not os.path.exists(path):
+        return {'epoch': 0, 'checkpoint': None, 'done': False, 'history': []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_state(job_dir, state):
+    '''Write the state atomically, so a crash leaves either the old or the new state'''
+    path = os.path.join(job_dir, 'state.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _train(corpus_path, checkpoint_dir, config):
+    '''Train one model in the current process, resuming from its last checkpoint'''
+    name = config['name']
+    job_dir = os.path.join(checkpoint_dir, name)
+    os.makedirs(job_dir, exist_ok=True)
+    state = _read_state(job_dir)
+    if state['done']:
+        print(f'{name} already trained')
+        return state
+
+    corpus = CompactCorpus(corpus_path)
+    params = dict(config['params'])
+    epochs = params.get('epochs', 10)
+    if state['checkpoint'] is not None:
+        model = Doc2Vec.load(os.path.join(job_dir, state['checkpoint'], 'model'))
+        model.workers = config['workers']
+        print(f'{name} resumed after epoch {state["epoch"]}')
+    else:
+        model = Doc2Vec(workers=config['workers'], **params)
+        model.build_vocab(corpus)
+
+    # linear learning rate decay over all epochs, one epoch per train call
+    alpha, min_alpha = model.alpha, model.min_alpha
+    words = corpus.total_words
+    for epoch in range(state['epoch'], epochs):
+        start_alpha = alpha - (alpha - min_alpha) * epoch / epochs
+        end_alpha = alpha - (alpha - min_alpha) * (epoch + 1) / epochs
+        start = time.perf_counter()
+        model.train(corpus.shuffled(seed=epoch), total_examples=model.corpus_count, epochs=1,
+                    start_alpha=start_alpha, end_alpha=end_alpha)
+        seconds = time.perf_counter() - start
+
+        checkpoint = f'epoch_{epoch + 1:03d}'
+        os.makedirs(os.path.join(job_dir, checkpoint), exist_ok=True)
+        model.save(os.path.join(job_dir, checkpoint, 'model'))
+        previous = state['checkpoint']
+        state['epoch'] = epoch + 1
+        state['checkpoint'] = checkpoint
+        state['history'].append({'epoch': epoch + 1, 'seconds': seconds, 'words': words,
+                                 'words_per_sec': words / seconds})
+        _write_state(job_dir, state)
+        if previous is not None:
+            shutil.rmtree(os.path.join(job_dir, previous), ignore_errors=True)
+        print(f'{name} epoch {epoch + 1}/{epochs}: {seconds:.1f}s, {words / seconds:.0f} words/sec')
+
+    ModelStore.save_model(model, os.path.join(job_dir, 'model'))
+    checkpoint = state['checkpoint']
+    state['done'] = True
+    state['checkpoint'] = None
+    _write_state(job_dir, state)
+    if checkpoint is not None:
+        shutil.rmtree(os.path.join(job_dir, checkpoint), ignore_errors=True)
+    return state
@@ -0,0 +1,42 @@
+import tempfile
+import time
+
+import numpy as np
+
+from AnnIndex import AnnIndex, recall_at_k
+
+#===============================================================================
+# Synthetic corpus: clustered vectors, like document vectors of related articles
+
+n_docs, n_queries, dim, n_topics, k = 200000, 1000, 100, 500, 10
+rng = np.random.default_rng(42)
+topics = rng.normal(size=(n_topics, dim)).astype(np.float32)
+corpus = topics[rng.integers(n_topics, size=n_docs)] + 0.5 * rng.normal(size=(n_docs, dim)).astype(np.float32)
+queries = topics[rng.integers(n_topics, size=n_queries)] + 0.5 * rng.normal(size=(n_queries, dim)).astype(np.float32)
+
+#===============================================================================
+# Build, save and load
+
+start = time.perf_counter()
+index = AnnIndex.build(corpus)
+print(f'Built index of {len(index)} vectors in {len(index.centroids)} lists in {time.perf_counter() - start:.1f}s')
+
+with tempfile.TemporaryDirectory() as path:
+    index.save(path)
+    start = time.perf_counter()
+    index = AnnIndex.load(path)
+    print(f'Loaded memory-mapped index in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    #===========================================================================
+    # Exact vs approximate search
+
+    start = time.perf_counter()
+    expected, _ = index.exact_search(queries, k)
+    seconds = time.perf_counter() - start
+    print(f'exact          recall@{k} 1.000  {n_queries / seconds:8.0f} QPS')
+
+    for nprobe in [1, 2, 4, 8, 16, 32]:
+        start = time.perf_counter()
+        found, _ = index.search(queries, k, nprobe=nprobe)
+        seconds = time.perf_counter() - start
+        print(f'nprobe={nprobe:<3}     recall@{k} {recall_at_k(found, expected):.3f}  {n_queries / seconds:8.0f} QPS')
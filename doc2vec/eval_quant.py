@@ -0,0 +1,45 @@
+import sys
+import time
+
+import numpy as np
+
+import Quantize
+from AnnIndex import AnnIndex, recall_at_k
+
+#===============================================================================
+# Vectors: a .npy file of document vectors given as argument, or a synthetic corpus
+
+k, n_queries = 10, 1000
+rng = np.random.default_rng(42)
+if len(sys.argv) > 1:
+    vectors = np.load(sys.argv[1]).astype(np.float32)
+    queries = vectors[rng.choice(len(vectors), size=n_queries, replace=False)]
+    queries = queries + 0.1 * queries.std() * rng.normal(size=queries.shape).astype(np.float32)
+else:
+    n_docs, dim, n_topics = 100000, 100, 500
+    topics = rng.normal(size=(n_topics, dim)).astype(np.float32)
+    vectors = topics[rng.integers(n_topics, size=n_docs)] + 0.5 * rng.normal(size=(n_docs, dim)).astype(np.float32)
+    queries = topics[rng.integers(n_topics, size=n_queries)] + 0.5 * rng.normal(size=(n_queries, dim)).astype(np.float32)
+print(f'{len(vectors)} vectors of {vectors.shape[1]} dims, {n_queries} queries')
+
+#===============================================================================
+# Exact search on quantized vectors vs float32
+
+# memory is the storage size of the vectors; scoring casts them to float32 by blocks of rows
+print(f'\nExact search    storage     ratio  recall@{k}   QPS')
+for result in Quantize.evaluate(vectors, queries, k):
+    print(f'{result["dtype"]:<12} {result["memory"] / 2**20:8.1f} MB  {result["memory_ratio"]:5.2f}  '
+          f'{result["recall"]:8.3f}  {result["qps"]:6.0f}')
+
+#===============================================================================
+# ANN index with quantized vectors vs exact float32 search
+
+expected, _ = AnnIndex.build(vectors, nlist=1).exact_search(queries, k)
+print(f'\nANN nprobe=8    storage     ratio  recall@{k}   QPS')
+for dtype in Quantize.DTYPES:
+    index = AnnIndex.build(vectors, dtype=dtype)
+    start = time.perf_counter()
+    found, _ = index.search(queries, k, nprobe=8)
+    seconds = time.perf_counter() - start
+    print(f'{dtype:<12} {index.vectors.nbytes / 2**20:8.1f} MB  {index.vectors.nbytes / (vectors.nbytes):5.2f}  '
+          f'{recall_at_k(found, expected):8.3f}  {n_queries / seconds:6.0f}')
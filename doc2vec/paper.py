@@ -56,15 +56,25 @@ def extract_documents():
                 yield create_sentiment_document(member.name, member_text, index)
                 index += 1
 
-alldocs = list(extract_documents())
+#===============================================================================
+# Tokenize once into a compact on-disk corpus, streamed from disk on every pass
+
+from Corpus import CompactCorpus
+
+corpus_path = 'aclImdb_corpus'
+if not os.path.isfile(os.path.join(corpus_path, 'meta.json')):
+    CompactCorpus.build(corpus_path, ((doc.words, {'split': doc.split, 'sentiment': doc.sentiment})
+                                      for doc in extract_documents()))
+
+alldocs = CompactCorpus(corpus_path)
 print(alldocs[27])
 
 
 #===============================================================================
 # Extract our documents and split into training/test sets.
 
-train_docs = [doc for doc in alldocs if doc.split == 'train']
-test_docs = [doc for doc in alldocs if doc.split == 'test']
+train_docs = alldocs.subset(alldocs.meta('split') == 'train')
+test_docs = alldocs.subset(alldocs.meta('split') == 'test')
 print(f'{len(alldocs)} docs: {len(train_docs)} train-sentiment, {len(test_docs)} test-sentiment')
 
 
@@ -76,65 +86,32 @@ from collections import OrderedDict
 import gensim.models.doc2vec
 assert gensim.models.doc2vec.FAST_VERSION > -1, "This will be painfully slow otherwise"
 
-from gensim.models.doc2vec import Doc2Vec
+from Trainer import TrainingOrchestrator
 
+cores = multiprocessing.cpu_count()
 common_kwargs = dict(
     vector_size=100, epochs=20, min_count=2,
-    sample=0, workers=multiprocessing.cpu_count(), negative=5, hs=0,
+    sample=0, negative=5, hs=0,
 )
 
-simple_models = [
+# the three models train side by side, each on a share of the cores
+model_configs = [
     # PV-DBOW plain
-    Doc2Vec(dm=0, **common_kwargs),
+    dict(name='dbow', params=dict(dm=0, **common_kwargs)),
     # PV-DM w/ default averaging; a higher starting alpha may improve CBOW/PV-DM modes
-    Doc2Vec(dm=1, window=10, alpha=0.05, comment='alpha=0.05', **common_kwargs),
+    dict(name='dmm', params=dict(dm=1, window=10, alpha=0.05, comment='alpha=0.05', **common_kwargs)),
     # PV-DM w/ concatenation - big, slow, experimental mode
     # window=5 (both sides) approximates paper's apparent 10-word total window size
-    Doc2Vec(dm=1, dm_concat=1, window=5, **common_kwargs),
+    dict(name='dmc', params=dict(dm=1, dm_concat=1, window=5, **common_kwargs)),
 ]
 
-for model in simple_models:
-    model.build_vocab(alldocs)
-    print(f"{model} vocabulary scanned & state initialized")
-
-models_by_name = OrderedDict((str(model), model) for model in simple_models)
-
-from gensim.test.test_doc2vec import ConcatenatedDoc2Vec
-models_by_name['dbow+dmm'] = ConcatenatedDoc2Vec([simple_models[0], simple_models[1]])
-models_by_name['dbow+dmc'] = ConcatenatedDoc2Vec([simple_models[0], simple_models[2]])
-
-
 #===============================================================================
 # Training evaluation metric
 
-import numpy as np
-import statsmodels.api as sm
-from random import sample
-
-def logistic_predictor_from_data(train_targets, train_regressors):
-    """Fit a statsmodel logistic predictor on supplied data"""
-    logit = sm.Logit(train_targets, train_regressors)
-    predictor = logit.fit(disp=0)
-    # print(predictor.summary())
-    return predictor
-
-def error_rate_for_model(test_model, train_set, test_set):
-    """Report error rate on test_doc sentiments, using supplied model and train_docs"""
-
-    train_targets = [doc.sentiment for doc in train_set]
-    train_regressors = [test_model.dv[doc.tags[0]] for doc in train_set]
-    train_regressors = sm.add_constant(train_regressors)
-    predictor = logistic_predictor_from_data(train_targets, train_regressors)
+from Evaluate import Evaluator
 
-    test_regressors = [test_model.dv[doc.tags[0]] for doc in test_set]
-    test_regressors = sm.add_constant(test_regressors)
-
-    # Predict & evaluate
-    test_predictions = predictor.predict(test_regressors)
-    corrects = sum(np.rint(test_predictions) == [doc.sentiment for doc in test_set])
-    errors = len(test_predictions) - corrects
-    error_rate = float(errors) / len(test_predictions)
-    return (error_rate, errors, len(test_predictions), predictor)
+# vectors are gathered once per model and split, and shared with the concatenated models
+evaluator = Evaluator(train_docs, test_docs, label='sentiment')
 
 
 #===============================================================================
@@ -143,24 +120,27 @@ def error_rate_for_model(test_model, train_set, test_set):
 from collections import defaultdict
 error_rates = defaultdict(lambda: 1.0)  # To selectively print only best errors achieved
 
-from random import shuffle
-shuffled_alldocs = alldocs[:]
-shuffle(shuffled_alldocs)
+# checkpointed after every epoch: rerunning the script resumes an interrupted training
+orchestrator = TrainingOrchestrator(corpus_path, 'aclImdb_models', cores=cores)
+training_stats = orchestrator.run(model_configs)
+for name, stats in training_stats.items():
+    for epoch in stats['history']:
+        print(f"{name} epoch {epoch['epoch']}: {epoch['seconds']:.1f}s, {epoch['words_per_sec']:.0f} words/sec")
 
-for model in simple_models:
-    print(f"Training {model}")
-    model.train(shuffled_alldocs, total_examples=len(shuffled_alldocs), epochs=model.epochs)
+simple_models = [orchestrator.load(config['name']) for config in model_configs]
+models_by_name = OrderedDict((str(model), model) for model in simple_models)
 
-    print(f"\nEvaluating {model}")
-    err_rate, err_count, test_count, predictor = error_rate_for_model(model, train_docs, test_docs)
-    error_rates[str(model)] = err_rate
-    print("\n%f %s\n" % (err_rate, model))
+from gensim.test.test_doc2vec import ConcatenatedDoc2Vec
+models_by_name['dbow+dmm'] = ConcatenatedDoc2Vec([simple_models[0], simple_models[1]])
+models_by_name['dbow+dmc'] = ConcatenatedDoc2Vec([simple_models[0], simple_models[2]])
 
-for model in [models_by_name['dbow+dmm'], models_by_name['dbow+dmc']]:
-    print(f"\nEvaluating {model}")
-    err_rate, err_count, test_count, predictor = error_rate_for_model(model, train_docs, test_docs)
-    error_rates[str(model)] = err_rate
-    print(f"\n{err_rate} {model}\n")
+# all the models, concatenations included, are evaluated in parallel
+print(f"\nEvaluating {', '.join(models_by_name)}")
+metrics_by_name = evaluator.evaluate(models_by_name, ks=(1, 10), sample_size=1000)
+for name, metrics in metrics_by_name.items():
+    error_rates[name] = metrics['error_rate']
+    print(f"\n{metrics['error_rate']} {name}: recall@1 {metrics['recall@1']:.3f}, "
+          f"recall@10 {metrics['recall@10']:.3f}, MRR {metrics['mrr']:.3f} ({metrics['seconds']:.1f}s)\n")
 
 #===============================================================================
 # Achieved Sentiment-Prediction Accuracy
@@ -0,0 +1,285 @@
+from elasticsearch import AsyncElasticsearch
+import elasticsearch
+import asyncio
+import math
+import json
+
+from ESClient import ESClient, connection_kwargs
+import QueryBuilder
+import Fusion
+from EmbedStage import tokenize
+
+
+class AsyncESClient(AsyncElasticsearch):
+    '''Asyncio variant of ESClient
+    The query methods are coroutines returning their results together with the raw
+    response, instead of storing it in the instance, so one client can serve many
+    concurrent requests from one event loop.
+
+    Example:
+    es = AsyncESClient('../config/martin_es.json')
+    results = await es.fan_out([es.match_filter('article', 'domain', d) for d in domains])
+    '''
+
+    def __init__(self, path_to_profile=None, **kwargs):
+        '''Authenticate access to Elasticsearch using the profile credentials, saved
+        in a JSON file in the folder auth
+        [in] path_to_profile: path to the profile. None to pass the client arguments as kwargs,
+             as options() does
+        '''
+        self.profile = {}
+        if path_to_profile is not None:
+            with open(path_to_profile) as f:
+                self.profile = json.load(f)
+            kwargs = connection_kwargs(self.profile)
+        AsyncElasticsearch.__init__(self, **kwargs)
+        self.queries = None
+        self.queries_by_id = {}
+
+    def options(self, **kwargs):
+        '''Copy of the client with other transport options, see ESClient.options'''
+        client = AsyncElasticsearch.options(self, **kwargs)
+        client.profile = self.profile
+        client.queries = self.queries
+        client.queries_by_id = self.queries_by_id
+        return client
+
+    # Stored queries are plain data, loading them does not need the event loop
+    load_queries_from_file = ESClient.load_queries_from_file
+    load_queries_from_json_dict = ESClient.load_queries_from_json_dict
+    _stored_query = ESClient._stored_query
+    timed = ESClient.timed
+
+    #
+    # ==================== fan_out ====================
+    #
+    async def fan_out(self, coros, concurrency=16):
+        '''Run many queries concurrently
+        [in] coros: coroutines to run, e.g. [es.match_filter(...), es.query_strings(...)]
+        [in] concurrency: maximum number of requests in flight at once
+        [ret] list of results, in the order of coros
+        '''
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(coro):
+            async with semaphore:
+                return await coro
+
+        return await asyncio.gather(*(run(coro) for coro in coros))
+
+    #
+    # ==================== query ====================
+    #
+    async def query(self, query_id):
+        '''Query an index with a stored query
+        [in] query_id: id of the query to run
+        [ret] ( total_query_hits, total_pages, response )
+        '''
+        query = self._stored_query(query_id)
+        if query is None:
+            return (0, 0, None)
+
+        try:
+            ret = await self.timed('search').search(index=query['index'], body=query['query_body'])
+            total_hits = ret['hits']['total']['value']
+            pages = math.ceil(total_hits / query['query_setting']['page_size'])
+            return (total_hits, pages, ret)
+        except Exception as e:
+            print(f'Error: {e}')
+            return (0, 0, None)
+
+    #
+    # ==================== query_page ====================
+    #
+    async def query_page(self, query_id, page_num):
+        '''Query a page of an index with a stored query
+        [in] query_id: id of the query to run
+        [in] page_num: page number to query
+        [ret] ( total_query_hits, next_exist, response )
+        '''
+        query = self._stored_query(query_id)
+        if query is None:
+            return (0, False, None)
+
+        try:
+            ret = await self.timed('search').search(index=query['index'],
+                                                    body=QueryBuilder.page_query(query, page_num))
+            total_hits = ret['hits']['total']['value']
+            next_exist = page_num * query['query_setting']['page_size'] < total_hits
+            return (total_hits, next_exist, ret)
+        except Exception as e:
+            print(f'Error: {e}')
+            return (0, False, None)
+
+    #
+    # ==================== query_batch ====================
+    #
+    async def query_batch(self, query_ids=None, queries_per_request=50, concurrency=4):
+        '''Run many stored queries with a few _msearch requests
+        [in] query_ids: ids of the queries to run. Default is all loaded queries
+        [in] queries_per_request: number of queries sent in one _msearch request
+        [in] concurrency: number of _msearch requests in flight at once
+        [ret] dict keyed by query id of ( total_query_hits, total_pages, hits )
+        '''
+        if self.queries is None:
+            print('Queries not loaded. Please load the query from json file first!')
+            return {}
+        if query_ids is None:
+            query_ids = list(self.queries_by_id)
+        queries = [query for query in map(self._stored_query, query_ids) if query is not None]
+        chunks = [queries[i:i + queries_per_request]
+                  for i in range(0, len(queries), queries_per_request)]
+
+        async def run(chunk):
+            try:
+                searches = QueryBuilder.msearch_body(chunk)
+                if elasticsearch.__version__[0] < 8:
+                    ret = await self.timed('search').msearch(body=searches)
+                else:
+                    ret = await self.timed('search').msearch(searches=searches)
+                return QueryBuilder.parse_msearch(chunk, ret['responses'])
+            except Exception as e:
+                print(f'Error: {e}')
+                return {query['query_id']: (0, 0, []) for query in chunk}
+
+        results = {}
+        for chunk_results in await self.fan_out([run(chunk) for chunk in chunks], concurrency):
+            results.update(chunk_results)
+        return results
+
+    #
+    # ==================== match_filter ====================
+    #
+    async def match_filter(self, index_name, field_name, match_term, count_mode=None, track_total_hits=True):
+        '''Match query
+        [ret] ( total_hits, response ). See ESClient.match_filter
+        '''
+        if count_mode is not None:
+            return await self._count_filter(index_name, QueryBuilder.filter_clause('match', field_name, match_term),
+                                            count_mode, track_total_hits)
+        return await self._search_total(index_name, QueryBuilder.match_query(field_name, match_term))
+
+    #
+    # ==================== term_filter ====================
+    #
+    async def term_filter(self, index_name, field_name, term_term, count_mode=None, track_total_hits=True):
+        '''Term query
+        [ret] ( total_hits, response ). See ESClient.term_filter
+        '''
+        if count_mode is not None:
+            return await self._count_filter(index_name, QueryBuilder.filter_clause('term', field_name, term_term),
+                                            count_mode, track_total_hits)
+        return await self._search_total(index_name, QueryBuilder.term_query(field_name, term_term))
+
+    #
+    # ==================== range_filter ====================
+    #
+    async def range_filter(self, index_name, field_name, minimum, maximum, count_mode=None, track_total_hits=True):
+        '''Range query
+        [ret] ( total_hits, response ). See ESClient.range_filter
+        '''
+        if count_mode is not None:
+            return await self._count_filter(index_name, QueryBuilder.filter_clause('range', field_name, minimum, maximum),
+                                            count_mode, track_total_hits)
+        return await self._search_total(index_name,
+                                        QueryBuilder.range_query(field_name, minimum, maximum))
+
+    #
+    # ==================== query_strings ====================
+    #
+    async def query_strings(self, index_name: str, field_names, operator: str = 'OR', highlight: bool = True, *phrases):
+        '''Query strings
+        [ret] ( total_hits, response ). See ESClient.query_strings
+        '''
+        query_body = QueryBuilder.query_strings_query(field_names, operator, highlight, phrases)
+        if query_body is None:
+            return (0, None)
+        return await self._search_total(index_name, query_body)
+
+    #
+    # ==================== hybrid_search ====================
+    #
+    async def hybrid_search(self, index_name, field_names, query_text, doc_emb, k=10, lexical_depth=50,
+                            vector_depth=50, num_candidates=100, fusion='rrf', rrf_k=60, weights=None,
+                            operator='OR', vector_field='vector'):
+        '''Hybrid lexical + vector search. The query is embedded in the default executor
+        [ret] list of hits, best first. See ESClient.hybrid_search
+        '''
+        if fusion not in ['rrf', 'weighted']:
+            print('Invalid fusion')
+            return []
+        lexical_body = QueryBuilder.query_strings_query(field_names, operator, False, [query_text])
+        if lexical_body is None:
+            return []
+        lexical_body['size'] = lexical_depth
+
+        async def lexical():
+            return (await self.timed('search').search(index=index_name, body=lexical_body))['hits']['hits']
+
+        async def vector():
+            query_vector = await asyncio.get_running_loop().run_in_executor(
+                None, doc_emb, tokenize(query_text))
+            query_body = QueryBuilder.knn_query(query_vector.tolist(), vector_depth, num_candidates,
+                                                vector_field)
+            return (await self.timed('search').search(index=index_name, body=query_body))['hits']['hits']
+
+        try:
+            ranked_lists = list(await asyncio.gather(lexical(), vector()))
+        except Exception as e:
+            print(f'Error: {e}')
+            return []
+
+        if fusion == 'rrf':
+            return Fusion.reciprocal_rank_fusion(ranked_lists, k=rrf_k, weights=weights, size=k)
+        return Fusion.weighted_score_fusion(ranked_lists, weights=weights, size=k)
+
+    #
+    # ==================== count_filters ====================
+    #
+    async def count_filters(self, index_name, filters):
+        '''Count the documents matching each of many filters with a single request
+        [ret] dict of the number of matching documents keyed by filter name. See ESClient.count_filters
+        '''
+        clauses = {name: QueryBuilder.filter_clause(*spec) for name, spec in filters.items()}
+        if None in clauses.values():
+            return {name: 0 for name in filters}
+
+        try:
+            body = QueryBuilder.filters_count_query(clauses)
+            ret = await self.timed('search').search(index=index_name, body=body)
+            buckets = ret['aggregations']['counts']['buckets']
+            return {name: buckets[name]['doc_count'] for name in filters}
+        except Exception as e:
+            print(f'Error: {e}')
+            return {name: 0 for name in filters}
+
+    #
+    # ==================== _count_filter ====================
+    #
+    async def _count_filter(self, index_name, clause, count_mode, track_total_hits):
+        '''Count the documents matching a clause and return ( total_hits, None )'''
+        if clause is None:
+            return (0, None)
+        try:
+            if count_mode == 'count':
+                body = {"query": {"bool": {"filter": [clause]}}}
+                ret = await self.timed('search').count(index=index_name, body=body)
+                return (ret['count'], None)
+            body = QueryBuilder.count_query(clause, track_total_hits)
+            ret = await self.timed('search').search(index=index_name, body=body)
+            return (ret['hits']['total']['value'], ret)
+        except Exception as e:
+            print(f'Error: {e}')
+            return (0, None)
+
+    #
+    # ==================== _search_total ====================
+    #
+    async def _search_total(self, index_name, query_body):
+        '''Run a search and return ( total_hits, response )'''
+        try:
+            ret = await self.timed('search').search(index=index_name, body=query_body)
+            return (ret['hits']['total']['value'], ret)
+        except Exception as e:
+            print(f'Error: {e}')
+            return (0, None)
@@ -0,0 +1,274 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import elasticsearch
+
+import Serializer
+
+
+class BulkIngester:
+    '''Parallel bulk ingestion engine
+    Records are grouped into batches by serialized size and sent by a pool of workers,
+    so several bulk requests are in flight at once. Each record is serialized once, when
+    added: the bytes used to size the batch are joined into the NDJSON body of the request.
+    The number of batches queued or in flight is bounded: add() blocks when the cluster
+    cannot keep up.
+
+    Example:
+    with BulkIngester(es, 'article', workers=8) as ingester:
+        for record in records:
+            ingester.add(record)
+    summary = ingester.summary
+    '''
+
+    def __init__(self, client, index_name, max_bytes=5 * 1024 * 1024, max_docs=5000,
+                 workers=4, queue_size=None, max_retries=5, initial_backoff=1.0,
+                 max_backoff=60.0, dead_letter_path='auto'):
+        '''
+        [in] client: Elasticsearch client used to send the bulk requests
+        [in] index_name: name of the index to ingest the records to
+        [in] max_bytes: maximum size of a bulk request body in bytes
+        [in] max_docs: maximum number of records in a bulk request
+        [in] workers: number of bulk requests in flight at once
+        [in] queue_size: number of full batches waiting for a worker. Default is workers
+        [in] max_retries: number of times rejected records (429/es_rejected_execution) are sent again
+        [in] initial_backoff: seconds to wait before the first retry, doubled on each retry
+        [in] max_backoff: maximum seconds to wait between retries
+        [in] dead_letter_path: NDJSON file to write the records that failed for good. 'auto' for
+             <index_name>.dead_letter.ndjson in the current directory, None to only report them.
+             The file is only created if a record fails
+        '''
+        self.client = client
+        self.index_name = index_name
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.workers = workers
+        self.queue_size = workers if queue_size is None else queue_size
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        if dead_letter_path == 'auto':
+            dead_letter_path = f'{index_name}.dead_letter.ndjson'
+        self.dead_letter = DeadLetterFile(dead_letter_path) if dead_letter_path else None
+        self.summary = []
+
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_count = 0
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    #
+    # ==================== add ====================
+    #
+    def add(self, record, doc_id=None, op='index'):
+        '''Add a record to the current batch, sending the batch when it is full
+        [in] record: record to ingest. The record must be a dict. Ignored for deletes
+        [in] doc_id: optional document id. With an id, indexing replaces the document: an upsert
+        [in] op: 'index', or 'delete' to delete the document doc_id
+        '''
+        action = {"_index": self.index_name}
+        if elasticsearch.__version__[0] < 8:
+            action["_type"] = "_doc"
+        if doc_id is not None:
+            action["_id"] = doc_id
+        action = {op: action}
+        if op == 'delete':
+            record = None
+
+        # NDJSON lines of this record; a delete has no source line
+        lines = Serializer.dumps(action) + b'\n'
+        if record is not None:
+            lines += Serializer.dumps(record) + b'\n'
+        if self._batch and (self._batch_bytes + len(lines) > self.max_bytes
+                            or len(self._batch) >= self.max_docs):
+            self.flush()
+        self._batch.append((action, record, lines))
+        self._batch_bytes += len(lines)
+
+    #
+    # ==================== flush ====================
+    #
+    def flush(self):
+        '''Hand the current batch to a worker. Blocks while the queue is full'''
+        if not self._batch:
+            return
+        batch, batch_bytes = self._batch, self._batch_bytes
+        self._batch, self._batch_bytes = [], 0
+        self._batch_count += 1
+
+        self._slots.acquire()
+        future = self._executor.submit(self._send, self._batch_count, batch, batch_bytes)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append((self._batch_count, len(batch), batch_bytes, future))
+
+    #
+    # ==================== close ====================
+    #
+    def close(self):
+        '''Send the last batch and wait for all the bulk requests to finish
+        [ret] per-batch summary, ordered by batch number
+        '''
+        self.flush()
+        self._executor.shutdown(wait=True)
+        for batch_num, docs, batch_bytes, future in self._futures:
+            e = future.exception()
+            if e is not None:
+                # the batch failed before recording its summary: count all its records as failed
+                print(f'Error: batch {batch_num} failed: {e}')
+                self.summary.append({'batch': batch_num, 'docs': docs, 'bytes': batch_bytes,
+                                     'indexed': 0, 'failed': docs, 'retried': 0, 'dead_lettered': 0,
+                                     'took': None, 'error': str(e)})
+        self._futures = []
+        self.summary.sort(key=lambda x: x['batch'])
+        return self.summary
+
+    #
+    # ==================== _send ====================
+    #
+    def _send(self, batch_num, batch, batch_bytes):
+        '''Send one batch and record its summary
+        Only the records rejected with a retryable error are sent again, with exponential
+        backoff. Records that still fail are written to the dead-letter file.
+        '''
+        result = {'batch': batch_num, 'docs': len(batch), 'bytes': batch_bytes,
+                  'indexed': 0, 'failed': 0, 'retried': 0, 'dead_lettered': 0,
+                  'took': None, 'error': None}
+        start = time.perf_counter()
+        pending = batch
+        attempt = 0
+        while pending:
+            failures = []
+            retry = []
+            try:
+                items = self._bulk(pending)
+                if len(items) < len(pending):
+                    # records without a result are not known to be indexed
+                    failures = [(action, record, None, 'missing from the bulk response')
+                                for action, record, _ in pending[len(items):]]
+                for entry, item in zip(pending, items):
+                    action, record, _ = entry
+                    status = item['status']
+                    if 200 <= status < 300 or (status == 404 and 'delete' in action):
+                        # deleting a document that is already gone is not a failure
+                        result['indexed'] += 1
+                    elif self._is_retryable(status, item.get('error')):
+                        retry.append(entry)
+                    else:
+                        failures.append((action, record, status, item.get('error')))
+            except Exception as e:
+                result['error'] = str(e)
+                if self._is_retryable(getattr(e, 'status_code', None), e):
+                    retry = pending
+                else:
+                    print(f'Error: {e}')
+                    failures = [(action, record, getattr(e, 'status_code', None), str(e))
+                                for action, record, _ in pending]
+
+            if retry and attempt >= self.max_retries:
+                failures.extend((action, record, 429, 'retries exhausted') for action, record, _ in retry)
+                retry = []
+            self._dead_letter(failures)
+            result['failed'] += len(failures)
+            result['dead_lettered'] += len(failures) if self.dead_letter is not None else 0
+
+            pending = retry
+            if pending:
+                backoff = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+                print(f'Batch {batch_num}: retrying {len(pending)} records in {backoff:.1f}s')
+                result['retried'] += len(pending)
+                attempt += 1
+                time.sleep(backoff)
+        result['took'] = time.perf_counter() - start
+
+        print(f'Batch {batch_num}: {result["indexed"]} of {result["docs"]} records indexed '
+              f'({batch_bytes / 1024:.0f} KB, {result["took"]:.2f}s)')
+        with self._lock:
+            self.summary.append(result)
+        return result
+
+    #
+    # ==================== _bulk ====================
+    #
+    def _bulk(self, batch):
+        '''Send one bulk request
+        [in] batch: list of (action, record, NDJSON lines), record being None for deletes
+        [ret] list of item results, one per record, each with at least a status
+        '''
+        # already serialized: the client sends the bytes as they are
+        operations = b''.join(lines for _, _, lines in batch)
+        if elasticsearch.__version__[0] < 8:
+            res = self.client.bulk(body=operations)
+        else:
+            res = self.client.bulk(operations=operations)
+        return [next(iter(item.values())) for item in res['items']]
+
+    #
+    # ==================== _is_retryable ====================
+    #
+    @staticmethod
+    def _is_retryable(status, error):
+        '''Whether a failed request or item is worth sending again'''
+        if status == 429:
+            return True
+        if isinstance(error, (elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout)):
+            return True
+        if isinstance(error, dict):
+            return error.get('type') == 'es_rejected_execution_exception'
+        return 'es_rejected_execution_exception' in str(error)
+
+    #
+    # ==================== _dead_letter ====================
+    #
+    def _dead_letter(self, failures):
+        '''Write the records that failed for good to the dead-letter file'''
+        if not failures:
+            return
+        if self.dead_letter is None:
+            print(f'Error: {len(failures)} records failed and no dead-letter file is set')
+            return
+        print(f'Error: {len(failures)} records failed, written to {self.dead_letter.path}')
+        self.dead_letter.write([{
+            "op": next(iter(action)),
+            "index": next(iter(action.values()))["_index"],
+            "id": next(iter(action.values())).get("_id"),
+            "status": status,
+            "error": error,
+            "doc": record
+        } for action, record, status, error in failures])
+
+
+class DeadLetterFile:
+    '''Append-only NDJSON file of records that could not be ingested
+    Each line holds the operation, target index, document id, failure status and error, and
+    the document itself, so the file can be replayed with ESClient.replay_dead_letters.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, entries):
+        '''Append entries to the file
+        [in] entries: list of dicts
+        '''
+        lines = ''.join(json.dumps(entry, default=str) + '\n' for entry in entries)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+
+    def __iter__(self):
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
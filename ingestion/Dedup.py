@@ -0,0 +1,379 @@
+import hashlib
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from EmbedStage import tokenize
+
+# Multipliers combining the token hashes of a shingle
+_SHINGLE_PRIMES = [np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F), np.uint64(0x165667B19E3779F9),
+                   np.uint64(0x27D4EB2F165667C5), np.uint64(0xFF51AFD7ED558CCD)]
+# Bits of each byte value, least significant first
+_BYTE_BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1, bitorder='little').astype(np.int64)
+
+
+def _popcount(values):
+    '''Number of set bits of each uint64'''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def _mix(x):
+    '''splitmix64 finalizer: spread the bits of uint64 hashes'''
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+#
+# ==================== hashes ====================
+#
+def content_hash(tokens):
+    '''64-bit hash of a text given by its tokens, so case and whitespace differences are ignored
+    when the tokens are those of the lower-cased text'''
+    return int.from_bytes(hashlib.blake2b(' '.join(tokens).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def token_hash(token):
+    '''64-bit hash of a token, the same in every process'''
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def simhash(token_hashes, lengths, shingle_size=3):
+    '''64-bit SimHash signatures of a batch of documents
+    Each bit is the majority vote of that bit over the hashes of the word shingles, so
+    documents sharing most of their shingles differ in few bits.
+    [in] token_hashes: uint64 array of the hashes of the tokens of all the documents, in order
+    [in] lengths: number of tokens of each document. Each must be at least shingle_size
+    [in] shingle_size: number of consecutive tokens per shingle
+    [ret] uint64 array of one signature per document
+    '''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    n = len(token_hashes) - shingle_size + 1
+    shingles = token_hashes[:n] * _SHINGLE_PRIMES[0]
+    for i in range(1, shingle_size):
+        shingles = shingles + token_hashes[i:n + i] * _SHINGLE_PRIMES[i % len(_SHINGLE_PRIMES)]
+    # drop the shingles overlapping two documents
+    doc_of_token = np.repeat(np.arange(len(lengths)), lengths)
+    keep = np.cumsum(lengths)[doc_of_token[:n]] - np.arange(n) >= shingle_size
+    shingles = _mix(shingles[keep])
+    docs = doc_of_token[:n][keep]
+
+    # votes of each bit: per-document histograms of each byte of the shingle hashes, times
+    # the bits of the 256 byte values
+    shingle_bytes = shingles.view(np.uint8).reshape(-1, 8)
+    bins = docs * 256
+    votes = np.hstack([np.bincount(bins + shingle_bytes[:, k], minlength=len(lengths) * 256)
+                       .reshape(len(lengths), 256) @ _BYTE_BITS for k in range(8)])
+    majority = votes * 2 > (lengths - shingle_size + 1)[:, None]
+    return np.packbits(majority, axis=1, bitorder='little').view(np.uint64)[:, 0]
+
+
+class DedupStage:
+    '''Ingestion stage detecting exact and near-duplicate records
+    Exact duplicates have the same text once lower-cased and tokenized. Near duplicates,
+    e.g. the same article with small edits, have SimHash signatures differing in at most
+    max_distance bits. They are found through a multi-probe LSH index: the 64 bits are split
+    into 4 bands of 16 bits, and each band is also probed with the keys within
+    max_distance // 4 bits of the query's, so every signature within max_distance bits
+    agrees with a probe of at least one band.
+
+    The index is kept in numpy arrays: the signatures, the exact hashes and the bands in
+    sorted arrays searched for a whole batch at once, and the records added since the last
+    sort in an unsorted tail compared directly. About 50 bytes per record plus its key.
+
+    Duplicates are dropped, tagged with the key of the original record, or merged: the
+    values of merge_fields, e.g. the URLs of the copies, are added to the original record
+    when it is in the same batch. Copies of records sent in earlier batches are dropped.
+
+    Example:
+    dedup = DedupStage(mode='merge', merge_fields=['url'])
+    es.ingest_bulk_from_csv_stream('article', 'articles.csv', stages=[dedup, embed_stage])
+    print(dedup.stats())
+    dedup.save('article.dedup.npz')
+    '''
+
+    BANDS = 4
+    BAND_BITS = 16
+
+    def __init__(self, fields=('title', 'content'), key_field='url', mode='drop', max_distance=8,
+                 shingle_size=2, min_tokens=10, tag_field='duplicate_of', merge_fields=('url',),
+                 merge_size=4096):
+        '''
+        [in] fields: fields whose text is compared
+        [in] key_field: field identifying a record, written in the tag of its duplicates
+        [in] mode: 'drop', 'tag' or 'merge'
+        [in] max_distance: maximum number of differing SimHash bits of near duplicates.
+             0 only keeps exact duplicate detection. With the defaults, copies of a 200-word
+             article with 1, 2 and 5 words replaced are within 8 bits about 100%, 99% and 85%
+             of the time, and unrelated articles are more than 10 bits apart. Larger values
+             catch more edited copies, but probe more keys and risk false positives
+        [in] shingle_size: number of consecutive tokens per shingle. Single words make
+             unrelated texts sharing common words look alike; longer shingles are changed
+             by more of the edits
+        [in] min_tokens: texts with fewer tokens, e.g. empty or title-only records, are passed
+             through unchecked: short texts are the same by chance across unrelated records
+        [in] tag_field: field set to the key of the original record, in the tag mode
+        [in] merge_fields: fields whose values are merged into the original record, in the merge mode
+        [in] merge_size: number of recent records compared directly before being sorted into
+             the index
+        '''
+        if mode not in ('drop', 'tag', 'merge'):
+            raise ValueError(f'Unknown dedup mode {mode}')
+        self.fields = list(fields)
+        self.key_field = key_field
+        self.mode = mode
+        self.max_distance = max_distance
+        self.shingle_size = shingle_size
+        self.min_tokens = min_tokens
+        self.tag_field = tag_field
+        self.merge_fields = list(merge_fields)
+        self.merge_size = merge_size
+
+        # XOR masks of the band keys within max_distance // BANDS bits
+        radius = max_distance // self.BANDS
+        self._probes = np.array([sum(1 << bit for bit in bits) for r in range(radius + 1)
+                                 for bits in itertools.combinations(range(self.BAND_BITS), r)], dtype=np.uint16)
+        self._band_shifts = [np.uint64(band * self.BAND_BITS) for band in range(self.BANDS)]
+        self._band_mask = np.uint64((1 << self.BAND_BITS) - 1)
+
+        self._count = 0
+        self._signatures = np.empty(1024, dtype=np.uint64)
+        self._exact_hashes = np.empty(1024, dtype=np.uint64)
+        self._near = np.empty(1024, dtype=bool)
+        self._key_offsets = np.zeros(1025, dtype=np.int64)
+        self._key_bytes = bytearray()
+        # rows below _indexed are in the sorted arrays, the others in the recent tail
+        self._indexed = 0
+        self._sorted_exact = np.empty(0, dtype=np.uint64)
+        self._sorted_exact_rows = np.empty(0, dtype=np.int32)
+        # rows of each band sorted by band key, the rows of key k being
+        # _sorted_rows[band][_band_offsets[band][k]:_band_offsets[band][k + 1]]
+        self._band_offsets = [np.zeros((1 << self.BAND_BITS) + 1, dtype=np.int64) for _ in range(self.BANDS)]
+        self._sorted_rows = [np.empty(0, dtype=np.int32) for _ in range(self.BANDS)]
+        self._recent_exact = {}
+        self._token_hashes = {}
+        self.counters = {'records': 0, 'skipped': 0, 'unique': 0, 'exact': 0, 'near': 0}
+
+    #
+    # ==================== __call__ ====================
+    #
+    def __call__(self, records):
+        tokens = [tokenize(' '.join(str(record.get(field) or '') for field in self.fields).lower())
+                  for record in records]
+        lengths = np.array([len(doc_tokens) for doc_tokens in tokens], dtype=np.int64)
+        checked = lengths >= max(self.min_tokens, 1)
+        near = checked & (lengths >= self.shingle_size) & (self.max_distance > 0)
+        signatures = np.zeros(len(records), dtype=np.uint64)
+        if near.any():
+            signatures[near] = simhash(self._hash_tokens([tokens[i] for i in np.flatnonzero(near)]),
+                                       lengths[near], self.shingle_size)
+        exact_hashes = np.array([content_hash(doc_tokens) if checked[i] else 0
+                                 for i, doc_tokens in enumerate(tokens)], dtype=np.uint64)
+        sorted_exact = self._sorted_exact_match(exact_hashes)
+        sorted_near = self._sorted_near_match(signatures, near)
+
+        output = []
+        originals = {}
+        for i, record in enumerate(records):
+            self.counters['records'] += 1
+            if not checked[i]:
+                self.counters['skipped'] += 1
+                output.append(record)
+                continue
+            row = sorted_exact[i] if sorted_exact[i] >= 0 else self._recent_exact.get(int(exact_hashes[i]))
+            kind = 'exact'
+            if row is None and near[i]:
+                row = self._find_near(signatures[i], sorted_near[i])
+                kind = 'near'
+            if row is None:
+                self.counters['unique'] += 1
+                originals[self._add(record, exact_hashes[i], signatures[i], near[i])] = record
+                output.append(record)
+                continue
+
+            row = int(row)
+            self.counters[kind] += 1
+            if self.mode == 'tag':
+                record[self.tag_field] = self._key(row)
+                output.append(record)
+            elif self.mode == 'merge' and row in originals:
+                self._merge(originals[row], record)
+        # after the batch, as its matches were searched in the sorted arrays before
+        if self._count - self._indexed >= self.merge_size:
+            self._rebuild()
+        return output
+
+    #
+    # ==================== stats ====================
+    #
+    def stats(self):
+        '''Get the dedup counters
+        [ret] dict with the numbers of records, records skipped as too short, unique records,
+              exact and near duplicates, and the rate of duplicates among the records
+        '''
+        stats = dict(self.counters)
+        duplicates = stats['exact'] + stats['near']
+        stats['duplicate_rate'] = duplicates / stats['records'] if stats['records'] > 0 else 0.0
+        stats['exact_rate'] = stats['exact'] / stats['records'] if stats['records'] > 0 else 0.0
+        stats['near_rate'] = stats['near'] / stats['records'] if stats['records'] > 0 else 0.0
+        return stats
+
+    #
+    # ==================== save / load ====================
+    #
+    def save(self, path):
+        '''Save the index of the records seen, e.g. to dedup the next ingestion against them
+        [in] path: path of the .npz file
+        '''
+        count = self._count
+        np.savez(path, signatures=self._signatures[:count], exact_hashes=self._exact_hashes[:count],
+                 near=self._near[:count], key_offsets=self._key_offsets[:count + 1],
+                 key_bytes=np.frombuffer(bytes(self._key_bytes), dtype=np.uint8))
+
+    def load(self, path):
+        '''Load an index saved with save, replacing the current one
+        [in] path: path of the .npz file
+        '''
+        data = np.load(path)
+        self._count = len(data['signatures'])
+        self._signatures = data['signatures'].copy()
+        self._exact_hashes = data['exact_hashes'].copy()
+        self._near = data['near'].copy()
+        self._key_offsets = data['key_offsets'].copy()
+        self._key_bytes = bytearray(data['key_bytes'].tobytes())
+        self._rebuild()
+        return self
+
+    #
+    # ==================== index ====================
+    #
+    def _hash_tokens(self, docs):
+        '''uint64 hashes of the tokens of documents, concatenated
+        Each distinct token of the batch is hashed once, and the hashes are cached: the
+        vocabulary of a crawl repeats a lot.
+        [in] docs: list of token lists
+        '''
+        codes, uniques = pd.factorize(np.fromiter(itertools.chain.from_iterable(docs), dtype=object,
+                                                  count=sum(len(doc) for doc in docs)))
+        cache = self._token_hashes
+        if len(cache) > 1000000:
+            cache.clear()
+        hashes = np.empty(len(uniques), dtype=np.uint64)
+        for i, token in enumerate(uniques):
+            value = cache.get(token)
+            if value is None:
+                value = cache[token] = token_hash(token)
+            hashes[i] = value
+        return hashes[codes]
+
+    def _sorted_exact_match(self, exact_hashes):
+        '''Row of the sorted index with each exact hash, -1 if none'''
+        if len(self._sorted_exact) == 0:
+            return np.full(len(exact_hashes), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_exact, exact_hashes), len(self._sorted_exact) - 1)
+        found = self._sorted_exact[positions] == exact_hashes
+        return np.where(found, self._sorted_exact_rows[positions], -1)
+
+    def _sorted_near_match(self, signatures, near, chunk_size=256):
+        '''Row of the closest signature of the sorted index within max_distance bits of each
+        signature, -1 if none. All the probes of a chunk of signatures are searched at once
+        '''
+        best = np.full(len(signatures), -1, dtype=np.int64)
+        queries = np.flatnonzero(near)
+        if self._indexed == 0 or len(queries) == 0:
+            return best
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            rows, owners = [], []
+            for offsets, sorted_rows, shift in zip(self._band_offsets, self._sorted_rows, self._band_shifts):
+                keys = ((signatures[chunk] >> shift) & self._band_mask).astype(np.uint16)
+                probes = (keys[:, None] ^ self._probes[None, :]).ravel()
+                lo = offsets[probes]
+                counts = offsets[probes.astype(np.int64) + 1] - lo
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                # positions lo[j] .. lo[j] + counts[j] - 1 of every probe j, concatenated
+                steps = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                rows.append(sorted_rows[np.repeat(lo, counts) + steps])
+                owners.append(np.repeat(np.repeat(chunk, len(self._probes)), counts))
+            if not rows:
+                continue
+            rows, owners = np.concatenate(rows), np.concatenate(owners)
+            distances = _popcount(self._signatures[rows] ^ signatures[owners])
+            keep = distances <= self.max_distance
+            rows, owners, distances = rows[keep], owners[keep], distances[keep]
+            # closest, then earliest, row of each signature
+            order = np.lexsort((rows, distances, owners))
+            owners, rows = owners[order], rows[order]
+            first = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]]) if len(owners) else owners
+            best[owners[first]] = rows[first]
+        return best
+
+    def _find_near(self, signature, sorted_row):
+        '''Row of the closest earlier near duplicate of a signature, None if there is none
+        [in] sorted_row: closest row of the sorted index, -1 if none
+        '''
+        rows = self._indexed + np.flatnonzero(self._near[self._indexed:self._count])
+        if sorted_row >= 0:
+            rows = np.r_[sorted_row, rows]
+        if len(rows) == 0:
+            return None
+        distances = _popcount(self._signatures[rows] ^ np.uint64(signature))
+        best = int(np.argmin(distances))
+        return int(rows[best]) if distances[best] <= self.max_distance else None
+
+    def _add(self, record, exact_hash, signature, near):
+        '''Index a unique record
+        [ret] its row
+        '''
+        row = self._count
+        if row == len(self._signatures):
+            self._signatures = np.resize(self._signatures, 2 * row)
+            self._exact_hashes = np.resize(self._exact_hashes, 2 * row)
+            self._near = np.resize(self._near, 2 * row)
+            self._key_offsets = np.resize(self._key_offsets, 2 * row + 1)
+        self._signatures[row] = signature
+        self._exact_hashes[row] = exact_hash
+        self._near[row] = near
+        self._key_bytes += str(record.get(self.key_field, row)).encode('utf-8')
+        self._key_offsets[row + 1] = len(self._key_bytes)
+        self._count += 1
+        self._recent_exact[int(exact_hash)] = row
+        return row
+
+    def _key(self, row):
+        return self._key_bytes[self._key_offsets[row]:self._key_offsets[row + 1]].decode('utf-8')
+
+    def _rebuild(self):
+        '''Sort all the records into the index arrays'''
+        count = self._count
+        order = np.argsort(self._exact_hashes[:count])
+        self._sorted_exact = self._exact_hashes[:count][order]
+        self._sorted_exact_rows = order.astype(np.int32)
+        rows = np.flatnonzero(self._near[:count]).astype(np.int32)
+        signatures = self._signatures[rows]
+        for band, shift in enumerate(self._band_shifts):
+            values = ((signatures >> shift) & self._band_mask).astype(np.uint16)
+            self._sorted_rows[band] = rows[np.argsort(values, kind='stable')]
+            self._band_offsets[band][1:] = np.cumsum(np.bincount(values, minlength=1 << self.BAND_BITS))
+        self._indexed = count
+        self._recent_exact = {}
+
+    def _merge(self, original, duplicate):
+        '''Add the values of the merge fields of a duplicate to the original record'''
+        for field in self.merge_fields:
+            value = duplicate.get(field)
+            if value is None or value == '':
+                continue
+            values = original.get(field)
+            values = [] if values is None or values == '' else values if isinstance(values, list) else [values]
+            for item in value if isinstance(value, list) else [value]:
+                if item not in values:
+                    values.append(item)
+            original[field] = values[0] if len(values) == 1 else values
@@ -1,37 +1,177 @@
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import elasticsearch
+import itertools
 import math
+import os
+import time
 import pandas as pd
 import json
 from pymongo import MongoClient
 
+from BulkIngester import BulkIngester, DeadLetterFile
+import Serializer
+from MongoSync import MongoSync
+import QueryBuilder
+import Fusion
+from QueryCache import QueryCache
+from EmbedStage import tokenize, vector_mapping
+
+
+# Transport options of the profile and their client argument names: ( 8.x and later, 7.x ).
+# None if the 7.x client has no equivalent
+TRANSPORT_OPTIONS = {
+    'request_timeout': ('request_timeout', 'timeout'),
+    'connections_per_node': ('connections_per_node', 'maxsize'),
+    'http_compress': ('http_compress', 'http_compress'),
+    'max_retries': ('max_retries', 'max_retries'),
+    'retry_on_timeout': ('retry_on_timeout', 'retry_on_timeout'),
+    'retry_on_status': ('retry_on_status', 'retry_on_status'),
+    'sniff_on_start': ('sniff_on_start', 'sniff_on_start'),
+    'sniff_on_node_failure': ('sniff_on_node_failure', 'sniff_on_connection_fail'),
+    'sniff_before_requests': ('sniff_before_requests', None),
+    'min_delay_between_sniffing': ('min_delay_between_sniffing', 'sniffer_timeout'),
+    'node_selector_class': ('node_selector_class', None),
+}
+
+
+#
+# ==================== connection_kwargs ====================
+#
+def connection_kwargs(profile):
+    '''Build the Elasticsearch client arguments from a profile
+    The profile gives one node as host, or several as hosts; requests are load balanced over
+    them. The optional transport section tunes the connection pool, e.g.
+    "transport": {"connections_per_node": 16, "http_compress": true, "request_timeout": 60,
+                  "max_retries": 3, "retry_on_timeout": true, "sniff_on_start": true,
+                  "node_selector_class": "round_robin"}
+    http_compress gzips the request bodies, bulk bodies included. See TRANSPORT_OPTIONS.
+    The optional serializer, "auto" (default), "orjson" or "json", encodes and decodes the
+    request and response bodies, see Serializer.client_kwargs.
+    [in] profile: profile loaded from a JSON file, with host or hosts, auth, transport and serializer
+    [ret] dict of keyword arguments for Elasticsearch or AsyncElasticsearch
+    '''
+    major = elasticsearch.__version__[0]
+    kwargs = dict(hosts=profile.get('hosts', profile.get('host')))
+    auth = profile.get('auth', {})
+    if len(auth) > 0:
+        kwargs['ca_certs'] = auth.get('ca_certs')
+        kwargs['http_auth' if major < 8 else 'basic_auth'] = (auth['username'], auth['password'])
+
+    transport = dict({'request_timeout': 60}, **profile.get('transport', {}))
+    for option, value in transport.items():
+        if option not in TRANSPORT_OPTIONS:
+            print(f'Error: unknown transport option {option}')
+            continue
+        name = TRANSPORT_OPTIONS[option][0 if major >= 8 else 1]
+        if name is None:
+            print(f'Error: transport option {option} needs elasticsearch 8 or later')
+            continue
+        kwargs[name] = value
+    kwargs.update(Serializer.client_kwargs(profile.get('serializer', 'auto')))
+    return kwargs
+
+
+#
+# ==================== index_body ====================
+#
+def index_body(index_config):
+    '''Build the body creating an index from an index configuration of the profile
+    The vector field named in the embedding section, if any, is mapped with the
+    quantization of the section. E.g. "embedding": {"field": "vector", "quantization": "int8"}
+    [in] index_config: one entry of profile['indices'], with scheme and settings
+    [ret] dict with settings and mappings
+    '''
+    properties = dict(index_config['scheme'])
+    embedding = index_config.get('embedding')
+    if embedding is not None and embedding.get('quantization') and embedding['field'] in properties:
+        field = properties[embedding['field']]
+        index_options = field.get('index_options', {})
+        properties[embedding['field']] = vector_mapping(
+            field['dims'], quantization=embedding['quantization'],
+            similarity=field.get('similarity', 'cosine'), m=index_options.get('m', 16),
+            ef_construction=index_options.get('ef_construction', 100))
+    return {
+        "settings": index_config['settings'],
+        "mappings": {
+            "properties": properties
+        }
+    }
+
+
+#
+# ==================== staged ====================
+#
+def staged(records, stages, batch_size=1000):
+    '''Apply ingestion stages to batches of records
+    [in] records: iterable of records
+    [in] stages: list of stages. A stage takes a list of records and returns a list of records
+    [in] batch_size: number of records passed to the stages at a time
+    [ret] generator of records
+    '''
+    if not stages:
+        yield from records
+        return
+    records = iter(records)
+    for batch in iter(lambda: list(itertools.islice(records, batch_size)), []):
+        for stage in stages:
+            batch = stage(batch)
+        yield from batch
+
 
 class ESClient(Elasticsearch):
     '''Class for accessing Elasticsearch'''
 
-    def __init__(self, path_to_profile):
+    def __init__(self, path_to_profile=None, **kwargs):
         '''Authenticate access to Elasticsearch using the profile credentials, saved
-        in a JSON file in the folder auth'''
-        with open(path_to_profile) as f:
-            self.profile = json.load(f)
-            if len(self.profile['auth']) > 0:
-                Elasticsearch.__init__(self,
-                                       self.profile['host'],
-                                       ca_certs=self.profile['auth']['ca_certs'],
-                                       timeout=60,
-                                       http_auth=(self.profile['auth']['username'], self.profile['auth']['password']))
-            else:
-                Elasticsearch.__init__(self, self.profile['host'])
+        in a JSON file in the folder auth
+        [in] path_to_profile: path to the profile. None to pass the client arguments as kwargs,
+             as options() does
+        '''
+        self.profile = {}
+        if path_to_profile is not None:
+            with open(path_to_profile) as f:
+                self.profile = json.load(f)
+            kwargs = connection_kwargs(self.profile)
+        Elasticsearch.__init__(self, **kwargs)
+        self.queries = None
+        self.queries_by_id = {}
+        self.cache = None
 
     def use_profile(self, path_to_profile):
         '''Use a different profile'''
         self.close()
         with open(path_to_profile) as f:
             self.profile = json.load(f)
-            Elasticsearch.__init__(self,
-                                   self.profile['auth']['host'],
-                                   ca_certs=self.profile['auth']['ca_certs'],
-                                   http_auth=(self.profile['auth']['username'], self.profile['auth']['password']))
+        Elasticsearch.__init__(self, **connection_kwargs(self.profile))
+
+    #
+    # ==================== options ====================
+    #
+    def options(self, **kwargs):
+        '''Copy of the client with other transport options, e.g. request_timeout, sharing the
+        connection pool, profile, stored queries and cache of this one'''
+        client = Elasticsearch.options(self, **kwargs)
+        client.profile = self.profile
+        client.queries = self.queries
+        client.queries_by_id = self.queries_by_id
+        client.cache = self.cache
+        return client
+
+    #
+    # ==================== timed ====================
+    #
+    def timed(self, operation):
+        '''Client applying the timeout of an operation type, set in the timeouts section of the
+        profile, e.g. "timeouts": {"search": 10, "bulk": 120}
+        With elasticsearch 7.x, or without a timeout for the operation, the client itself.
+        [in] operation: type of operation, e.g. search or bulk
+        '''
+        timeout = self.profile.get('timeouts', {}).get(operation)
+        if timeout is None or elasticsearch.__version__[0] < 8:
+            return self
+        return self.options(request_timeout=timeout)
 
     #
     # ==================== get_index ====================
@@ -62,8 +202,21 @@ class ESClient(Elasticsearch):
     #
     # ==================== create_index ====================
     #
-    def create_index(self, index_name, use_config=True, body=None):
-        '''Create an index'''
+    def create_index(self, index_name, use_config=True, body=None, config_name=None):
+        '''Create an index
+        [in] index_name: name of the index to create
+        [in] use_config: create the index from an index configuration of the profile
+        [in] body: body of the index, used when use_config is False
+        [in] config_name: name of the index configuration to use, without prompting.
+             Default is to prompt for it
+        '''
+        if use_config and config_name is not None:
+            index_config = self._index_config(config_name)
+            if index_config is None:
+                print(f'Index configuration {config_name} not found')
+                return None
+            print(f'Creating index {index_name} with configuration {config_name}')
+            return self.indices.create(index=index_name, body=index_body(index_config))
         if use_config:
             index_names = [index['index'] for index in self.profile["indices"]]
             print(f'Available index configurations: {index_names}')
@@ -73,17 +226,11 @@ class ESClient(Elasticsearch):
                 print(f'Index configuration {selected_index_name} not found')
                 return None
             else:
-                index_config = [index for index in self.profile["indices"]
-                                if index['index'] == selected_index_name][0]
+                index_config = self._index_config(selected_index_name)
                 print(f'Index configuration details:\n {index_config}')
                 print('Do you want to use this configuration? (y/n)')
                 if input() == 'y':
-                    body = {
-                        "settings": index_config['settings'],
-                        "mappings": {
-                            "properties": index_config['scheme']
-                        }
-                    }
+                    body = index_body(index_config)
                     print(
                         f'Creating index {index_name} with configuration {selected_index_name}')
                     return self.indices.create(index=index_name, body=body)
@@ -92,6 +239,154 @@ class ESClient(Elasticsearch):
         else:
             return self.indices.create(index=index_name, body=body)
 
+    def _index_config(self, config_name):
+        '''Get an index configuration of the profile by name, None if not found'''
+        for index_config in self.profile["indices"]:
+            if index_config['index'] == config_name:
+                return index_config
+        return None
+
+    #
+    # ==================== bulk_load_mode ====================
+    #
+    @contextmanager
+    def bulk_load_mode(self, index_name, force_merge=False, max_num_segments=1):
+        '''Context manager tuning an index for a bulk load
+        Refreshes are disabled and replicas dropped during the load, so each document is
+        indexed once and segments are not flushed every second. On exit, even on error, the
+        previous settings are restored and the index refreshed.
+
+        Example:
+        with es.bulk_load_mode('article', force_merge=True):
+            es.ingest_bulk_from_csv_stream('article', 'articles.csv')
+
+        [in] index_name: name of the index to load
+        [in] force_merge: force-merge the index after a successful load, e.g. for a read-only index.
+             See force_merge
+        [in] max_num_segments: number of segments per shard of the force merge
+        '''
+        settings = self.indices.get_settings(index=index_name, flat_settings=True)[index_name]['settings']
+        # unset settings are restored to null, i.e. to the default
+        previous = {'index.refresh_interval': settings.get('index.refresh_interval'),
+                    'index.number_of_replicas': settings.get('index.number_of_replicas')}
+        self.indices.put_settings(index=index_name, body={'index.refresh_interval': '-1',
+                                                          'index.number_of_replicas': 0})
+        print(f'Bulk load mode on for {index_name}, previous settings {previous}')
+        try:
+            yield
+        finally:
+            self.indices.put_settings(index=index_name, body=previous)
+            self.indices.refresh(index=index_name)
+            self._invalidate(index_name)
+            print(f'Bulk load mode off for {index_name}')
+        if force_merge:
+            self.force_merge(index_name, max_num_segments)
+
+    #
+    # ==================== force_merge ====================
+    #
+    def force_merge(self, index_name, max_num_segments=1, poll_interval=10):
+        '''Force-merge an index and wait for the merge, however long it takes
+        The merge runs as a task polled every poll_interval seconds, so no request waits for
+        it past the client timeout.
+        [in] index_name: name of the index to merge
+        [in] max_num_segments: number of segments per shard
+        [in] poll_interval: seconds between two checks of the task
+        '''
+        start = time.perf_counter()
+        if elasticsearch.__version__[0] < 8:
+            # no merge task: the request itself waits, without the default timeout
+            self.indices.forcemerge(index=index_name, max_num_segments=max_num_segments,
+                                    request_timeout=24 * 3600)
+        else:
+            task = self.indices.forcemerge(index=index_name, max_num_segments=max_num_segments,
+                                           wait_for_completion=False)['task']
+            while not self.tasks.get(task_id=task)['completed']:
+                time.sleep(poll_interval)
+        self._invalidate(index_name)
+        print(f'Force-merged {index_name} to {max_num_segments} segments per shard '
+              f'({time.perf_counter() - start:.0f}s)')
+
+    #
+    # ==================== swap_alias ====================
+    #
+    def swap_alias(self, alias, index_name, delete_old=False, replace_index=False):
+        '''Atomically point an alias to an index
+        The alias is removed from its previous indices and added to the new one in a single
+        request, so readers of the alias never see no index nor both.
+        [in] alias: name of the alias, e.g. article
+        [in] index_name: index the alias points to afterwards, e.g. article-20240101
+        [in] delete_old: delete the indices the alias pointed to before
+        [in] replace_index: if a concrete index is named like the alias, e.g. before the first
+             swap, delete it in the same request. Otherwise the swap is refused
+        [ret] list of the indices the alias pointed to before
+        '''
+        actions = []
+        old_indices = []
+        if self.indices.exists_alias(name=alias):
+            old_indices = [name for name in self.indices.get_alias(name=alias) if name != index_name]
+            actions += [{'remove': {'index': name, 'alias': alias}} for name in old_indices]
+        elif self.indices.exists(index=alias):
+            if not replace_index:
+                print(f'Error: {alias} is an index, not an alias. Use replace_index=True to replace it')
+                return None
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': index_name, 'alias': alias}})
+        self.indices.update_aliases(body={'actions': actions})
+        self._invalidate(alias)
+        print(f'Alias {alias} moved from {old_indices} to {index_name}')
+
+        if delete_old:
+            for name in old_indices:
+                self.delete_index(name)
+        return old_indices
+
+    #
+    # ==================== rebuild_index ====================
+    #
+    def rebuild_index(self, alias, config_name, load, version=None, force_merge=False, delete_old=False,
+                      replace_index=False):
+        '''Build a new versioned index and move an alias to it, without downtime
+        Readers keep using the alias on the current index while the new one is created and
+        loaded in bulk load mode. The alias moves only once the load is complete: if any
+        document failed, the alias is left as it is and the new index kept for inspection.
+
+        Example:
+        es.rebuild_index('article', 'article',
+                         lambda index_name: es.ingest_bulk_from_csv_stream(index_name, 'articles.csv'))
+
+        [in] alias: name of the alias the readers use
+        [in] config_name: index configuration of the profile of the new index
+        [in] load: function taking the name of the new index, loading the documents and returning
+             the summary of the ingestion: the per-batch summary of ingest_bulk_from_list or the
+             statistics of ingest_bulk_from_csv_stream
+        [in] version: suffix of the new index name. Default is the current time
+        [in] force_merge: force-merge the new index after the load
+        [in] delete_old: delete the indices the alias pointed to before
+        [in] replace_index: see swap_alias
+        [ret] name of the new index, None if it could not be created or loaded
+        '''
+        if not replace_index and not self.indices.exists_alias(name=alias) and self.indices.exists(index=alias):
+            # checked before the load, which the refused swap would waste
+            print(f'Error: {alias} is an index, not an alias. Use replace_index=True to replace it')
+            return None
+        index_name = f'{alias}-{version or time.strftime("%Y%m%d%H%M%S")}'
+        if self.create_index(index_name, config_name=config_name) is None:
+            return None
+        with self.bulk_load_mode(index_name, force_merge=force_merge):
+            summary = load(index_name)
+        if summary is None:
+            print(f'Error: load returned no ingestion summary, alias {alias} not moved to {index_name}')
+            return None
+        batches = summary['batches'] if isinstance(summary, dict) else summary
+        failed = sum(batch['failed'] for batch in batches)
+        if failed > 0:
+            print(f'Error: {failed} documents failed to load, alias {alias} not moved to {index_name}')
+            return None
+        if self.swap_alias(alias, index_name, delete_old=delete_old, replace_index=replace_index) is None:
+            return None
+        return index_name
+
     #
     # ==================== delete_index ====================
     #
@@ -99,6 +394,7 @@ class ESClient(Elasticsearch):
         '''Delete an index
         [in] index_name: name of the index to delete
         '''
+        self._invalidate(index_name)
         return self.indices.delete(index=index_name)
 
     #
@@ -110,116 +406,233 @@ class ESClient(Elasticsearch):
         [in] record: record to ingest. The record must be a dict
         '''
         # TODO: check the record is a dict
-        return self.index(index=index_name, doc_type='_doc', body=record)
+        ret = self.index(index=index_name, doc_type='_doc', body=record)
+        self._invalidate(index_name)
+        return ret
 
     #
     # ==================== ingest_bulk_from_list ====================
     #
-    def ingest_bulk_from_list(self, index_name, records):
+    def ingest_bulk_from_list(self, index_name, records, max_bytes=5 * 1024 * 1024, workers=4,
+                              stages=(), **bulk_options):
         '''Ingest bulk data from a list of records
+        Records are batched by serialized size and several bulk requests are sent in parallel.
         [in] index_name: name of the index to ingest the records to
-        [in] records: list of records to ingest. Each record must be a dict
+        [in] records: list (or any iterable) of records to ingest. Each record must be a dict
+        [in] max_bytes: maximum size of a bulk request body in bytes
+        [in] workers: number of bulk requests in flight at once
+        [in] stages: ingestion stages, e.g. EmbedStage, applied in order to batches of records
+             before they are sent. A stage takes a list of records and returns a list of records
+        [in] bulk_options: retry and dead-letter options of BulkIngester, e.g. max_retries,
+             initial_backoff, dead_letter_path. Records failing for good are written by default
+             to <index_name>.dead_letter.ndjson
+        [ret] per-batch summary: list of dicts with the batch number, number of records,
+              body size, number of indexed, retried, failed and dead-lettered records,
+              duration and error if any
         '''
-        batch_size = 800
-        batch_starts = [*range(0, len(records), batch_size)]
-        if batch_starts[-1] != len(records):
-            batch_starts.append(len(records))
-
-        for i in range(len(batch_starts)-1):
-            batch = records[batch_starts[i]:batch_starts[i+1]]
-            print(
-                f'Ingesting batch {i+1} of {batch_starts[i+1] - batch_starts[i]} records...')
-
-            if elasticsearch.__version__[0] < 8:
-                # create bulk actions
-                actions = []
-                for record in batch:
-                    action = {
-                        "_index": index_name,
-                        "_type": "_doc",
-                        "_source": record
-                    }
-                    actions.append(action)
-                    try:
-                        helpers.bulk(self, actions)
-                        return True
-                    except Exception as e:
-                        print(f'Error: {e}')
-                        return False
-            else:
-                # create bulk actions
-                actions = []
-                for record in batch:
-                    action = {"index": {"_index": index_name}}
-                    actions.append(action)
-                    actions.append(record)
-                try:
-                    self.bulk(index=index_name, operations=actions)
-                    return True
-                except Exception as e:
-                    print(f'Error: {e}')
-                    continue
-
-        return True
+        with BulkIngester(self.timed('bulk'), index_name, max_bytes=max_bytes, workers=workers,
+                          **bulk_options) as ingester:
+            for record in staged(records, stages):
+                ingester.add(record)
+        self._invalidate(index_name)
+        return ingester.summary
 
     #
     # ==================== ingest_bulk_from_csv ====================
     #
-    def ingest_bulk_from_csv(self, index_name, csv_file):
+    def ingest_bulk_from_csv(self, index_name, csv_file, max_bytes=5 * 1024 * 1024, workers=4,
+                             stages=(), **bulk_options):
         '''Ingest bulk data from a CSV file
         [in] index_name: name of the index to ingest the records to
         [in] csv_file: path to the CSV file to ingest
+        [in] max_bytes: maximum size of a bulk request body in bytes
+        [in] workers: number of bulk requests in flight at once
+        [in] stages: ingestion stages, see ingest_bulk_from_list
+        [in] bulk_options: retry and dead-letter options, see ingest_bulk_from_list. Records
+             failing for good are written by default next to the CSV file, e.g. to
+             articles.dead_letter.ndjson
+        [ret] per-batch summary, see ingest_bulk_from_list
         '''
+        bulk_options.setdefault('dead_letter_path', os.path.splitext(csv_file)[0] + '.dead_letter.ndjson')
         data = pd.read_csv(csv_file)
         data.fillna('', inplace=True)
-        scheme = self.indices.get_mapping(index=index_name)[
-            index_name]['mappings']['properties']
-        field_names = [field for field in scheme.keys()]
+        field_names = self._mapping_fields(index_name)
         data_trim = data[field_names]
         records = data_trim.to_dict(orient='records')
+        return self.ingest_bulk_from_list(index_name, records, max_bytes=max_bytes, workers=workers,
+                                          stages=stages, **bulk_options)
+
+    #
+    # ==================== ingest_bulk_from_csv_stream ====================
+    #
+    def ingest_bulk_from_csv_stream(self, index_name, csv_file, chunk_size=10000,
+                                    max_bytes=5 * 1024 * 1024, workers=4, stages=(), **bulk_options):
+        '''Ingest bulk data from a CSV file without loading the whole file in memory
+        The file is parsed in chunks of chunk_size rows and projected to the fields of the
+        index mapping. Bulk requests are sent by background workers while the next chunk is
+        parsed; the number of pending batches is bounded, so memory stays flat.
+        [in] index_name: name of the index to ingest the records to
+        [in] csv_file: path to the CSV file to ingest
+        [in] chunk_size: number of CSV rows parsed at a time
+        [in] max_bytes: maximum size of a bulk request body in bytes
+        [in] workers: number of bulk requests in flight at once
+        [in] stages: ingestion stages, see ingest_bulk_from_list. They are applied to each chunk
+        [in] bulk_options: retry and dead-letter options, see ingest_bulk_from_csv
+        [ret] dict with the number of rows sent and indexed, failed batches, elapsed seconds,
+              rows/sec and the per-batch summary
+        '''
+        bulk_options.setdefault('dead_letter_path', os.path.splitext(csv_file)[0] + '.dead_letter.ndjson')
+        field_names = self._mapping_fields(index_name)
+        # every column read as text: a chunk where a column is empty would otherwise infer
+        # float64 for it, and types would change from chunk to chunk
+        reader = pd.read_csv(csv_file, usecols=lambda column: column in field_names,
+                             chunksize=chunk_size, dtype=str, keep_default_na=False)
 
-        batch_size = 800
-        batch_starts = [*range(0, len(records), batch_size)]
-        if batch_starts[-1] != len(records):
-            batch_starts.append(len(records))
+        stats = {'rows': 0}
+        start = time.perf_counter()
+        with BulkIngester(self.timed('bulk'), index_name, max_bytes=max_bytes, workers=workers,
+                          **bulk_options) as ingester:
+            for chunk in reader:
+                records = chunk.to_dict(orient='records')
+                for stage in stages:
+                    records = stage(records)
+                for record in records:
+                    ingester.add(record)
+                stats['rows'] += len(chunk)
+                elapsed = time.perf_counter() - start
+                print(f'Parsed {stats["rows"]} rows, {stats["rows"] / elapsed:.0f} rows/sec')
 
-        for i in range(len(batch_starts)-1):
-            batch = records[batch_starts[i]:batch_starts[i+1]]
-            print(
-                f'Ingesting batch {i+1} of {batch_starts[i+1] - batch_starts[i]} records...')
+        stats['seconds'] = time.perf_counter() - start
+        stats['rows_per_sec'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+        stats['indexed'] = sum(batch['indexed'] for batch in ingester.summary)
+        stats['failed_batches'] = sum(1 for batch in ingester.summary if batch['failed'] > 0)
+        stats['batches'] = ingester.summary
+        self._invalidate(index_name)
+        print(f'Finished ingesting {stats["indexed"]} of {stats["rows"]} rows in {stats["seconds"]:.1f}s '
+              f'({stats["rows_per_sec"]:.0f} rows/sec), {stats["failed_batches"]} failed batches')
+        return stats
+
+    #
+    # ==================== replay_dead_letters ====================
+    #
+    def replay_dead_letters(self, path, index_name=None, **bulk_options):
+        '''Send again the records of a dead-letter file written by the bulk ingestion
+        [in] path: path to the NDJSON dead-letter file
+        [in] index_name: index to send the records to. Default is the index of each record
+        [in] bulk_options: options of BulkIngester. Records failing again are written to the
+             dead_letter_path given here, by default the replayed file with a .retry.ndjson
+             extension. It must differ from the replayed file
+        [ret] dict of per-batch summaries, keyed by index name
+        '''
+        retry_path = bulk_options.get('dead_letter_path', 'auto')
+        if retry_path == 'auto':
+            # not <index_name>.dead_letter.ndjson, which may be the replayed file
+            retry_path = bulk_options['dead_letter_path'] = os.path.splitext(path)[0] + '.retry.ndjson'
+        if retry_path and os.path.abspath(retry_path) == os.path.abspath(path):
+            print(f'Error: records failing again cannot be written to the replayed file {path}')
+            return {}
+        ingesters = {}
+        try:
+            for entry in DeadLetterFile(path):
+                target = index_name or entry['index']
+                if target not in ingesters:
+                    ingesters[target] = BulkIngester(self.timed('bulk'), target, **bulk_options)
+                ingesters[target].add(entry['doc'], doc_id=entry.get('id'), op=entry.get('op', 'index'))
+        finally:
+            summaries = {target: ingester.close() for target, ingester in ingesters.items()}
+            for target in summaries:
+                self._invalidate(target)
+        return summaries
+
+    #
+    # ==================== sync_from_mongo ====================
+    #
+    def sync_from_mongo(self, mongo_uri, database, collection, index_name, checkpoint_path,
+                        mode='watermark', **sync_options):
+        '''Sync the documents of a MongoDB collection changed since the last sync
+        Instead of a full re-export, only the delta is read, by updated-at watermark or change
+        stream, and upserted by _id. See MongoSync.
+        [in] mongo_uri: MongoDB connection string
+        [in] database: name of the database
+        [in] collection: name of the collection
+        [in] index_name: name of the index to sync the documents to
+        [in] checkpoint_path: JSON file of the sync position, created by the first sync
+        [in] mode: 'watermark' or 'change_stream'
+        [in] sync_options: options of MongoSync, e.g. updated_field, deleted_field, batch_size,
+             stages, and of BulkIngester, e.g. workers, dead_letter_path
+        [ret] dict with the number of batches, upserted, deleted and failed documents, elapsed
+              seconds and the checkpoint
+        '''
+        mongo = MongoClient(mongo_uri)
+        try:
+            sync = MongoSync(mongo[database][collection], self.timed('bulk'), index_name, checkpoint_path,
+                             mode=mode, **sync_options)
+            return sync.run()
+        finally:
+            mongo.close()
+
+    #
+    # ==================== enable_cache ====================
+    #
+    def enable_cache(self, max_entries=1024, ttl=60.0):
+        '''Cache the responses of the searches run by the query and filter methods
+        Ingesting through this client drops the cached responses of the index written to.
+        [in] max_entries: maximum number of cached responses, the least recently used is evicted
+        [in] ttl: seconds a response stays valid
+        '''
+        self.cache = QueryCache(max_entries=max_entries, ttl=ttl)
+
+    #
+    # ==================== disable_cache ====================
+    #
+    def disable_cache(self):
+        '''Stop caching search responses'''
+        self.cache = None
+
+    #
+    # ==================== cache_stats ====================
+    #
+    def cache_stats(self):
+        '''Get the hit/miss counters of the search cache
+        [ret] dict of counters, see QueryCache.stats, or None if the cache is disabled
+        '''
+        return self.cache.stats() if self.cache is not None else None
+
+    #
+    # ==================== _search ====================
+    #
+    def _search(self, index_name, query_body):
+        '''Run a search, through the cache if it is enabled'''
+        if self.cache is None:
+            return self.timed('search').search(index=index_name, body=query_body)
+        ret = self.cache.get(index_name, query_body)
+        if ret is None:
+            ret = self.timed('search').search(index=index_name, body=query_body)
+            self.cache.put(index_name, query_body, ret)
+        return ret
+
+    #
+    # ==================== _invalidate ====================
+    #
+    def _invalidate(self, index_name):
+        '''Drop the cached responses of an index after writing to it'''
+        if self.cache is not None:
+            self.cache.invalidate(index_name)
+
+    #
+    # ==================== _mapping_fields ====================
+    #
+    def _mapping_fields(self, index_name, exclude_types=('dense_vector',)):
+        '''Get the field names of an index mapping
+        [in] index_name: name of the index
+        [in] exclude_types: field types to leave out. Vector fields are computed at ingestion,
+             not read from the source files
+        [ret] list of field names
+        '''
+        scheme = self.indices.get_mapping(index=index_name)[
+            index_name]['mappings']['properties']
+        return [field for field, config in scheme.items() if config.get('type') not in exclude_types]
 
-            if elasticsearch.__version__[0] < 8:
-                # create bulk actions
-                actions = []
-                for record in batch:
-                    action = {
-                        "_index": index_name,
-                        "_type": "_doc",
-                        "_source": record
-                    }
-                    actions.append(action)
-                    try:
-                        helpers.bulk(self, actions)
-                        return True
-                    except Exception as e:
-                        print(f'Error: {e}')
-                        return False
-            else:
-                # create bulk actions
-                actions = []
-                for record in batch:
-                    action = {"index": {"_index": index_name}}
-                    actions.append(action)
-                    actions.append(record)
-
-                try:
-                    self.bulk(index=index_name, operations=actions)
-                    return True
-                except Exception as e:
-                    print(f'Error: {e}')
-                    continue
-        return True
-    
     #
     # ==================== load_queries_from_file ====================
     #
@@ -231,10 +644,12 @@ class ESClient(Elasticsearch):
             with open(path_to_file) as f:
                 self.queries = json.load(f)
             # print( "Queries loaded: \n", self.queries )
+            self.queries_by_id = {query['query_id']: query for query in self.queries}
             return True
         except Exception as e:
             print(f'Error: {e}')
             self.queries = None
+            self.queries_by_id = {}
             return False
 
     #
@@ -245,8 +660,11 @@ class ESClient(Elasticsearch):
         [in] index_name: name of the index to query
         [in] query_dict: json dict containing the query body
         '''
+        if self.queries is None:
+            self.queries = []
+            self.queries_by_id = {}
         query = {
-            "query_id": len(self.queries) + 1,
+            "query_id": max(self.queries_by_id, default=0) + 1,
             "index": index_name,
             "query_setting": {
                 "page_size": 20
@@ -258,7 +676,8 @@ class ESClient(Elasticsearch):
             }
         }
         self.queries.append(query)
-        return len(self.queries)
+        self.queries_by_id[query['query_id']] = query
+        return query['query_id']
 
     #
     # ==================== query ====================
@@ -269,19 +688,14 @@ class ESClient(Elasticsearch):
         [in] query_id: id of the query to run
         [ret] ( total_query_hits, total_pages): total number of hits and total number of pages
         '''
-        if self.queries is None:
-            print('Queries not loaded. Please load the query from json file first!')
+        query = self._stored_query(query_id)
+        if query is None:
             return (0, 0)
         else:
-            query = next(x for x in self.queries if x['query_id'] == query_id)
-            if query is None:
-                print(f'Query {query_id} not found')
-                return (0, 0)
             print(query['query_body'])
 
             try:
-                self.query_ret = self.search(
-                    index=query['index'], body=query['query_body'])
+                self.query_ret = self._search(query['index'], query['query_body'])
                 total_hits = self.query_ret['hits']['total']['value']
                 pages = math.ceil(
                     total_hits / query['query_setting']['page_size'])
@@ -302,26 +716,18 @@ class ESClient(Elasticsearch):
         [in] page_num: page number to query
         [ret] ( total_query_hits, next_exist): total number of hits and whether there is a next page
         '''
-        if self.queries is None:
-            print('Queries not loaded. Please load the query from json file first!')
+        query = self._stored_query(query_id)
+        if query is None:
             return (0, False)
         else:
-            query = next(x for x in self.queries if x['query_id'] == query_id)
-            if query is None:
-                print(f'Query {query_id} not found')
-                return (0, False)
             print(query['query_body'])
 
             try:
-                query_body = query['query_body']
-                query_body['from'] = (page_num - 1) * \
-                    query['query_setting']['page_size']
-                query_body['size'] = query['query_setting']['page_size']
-                self.query_ret = self.search(
-                    index=query['index'], body=query_body)
+                query_body = QueryBuilder.page_query(query, page_num)
+                self.query_ret = self._search(query['index'], query_body)
                 total_hits = self.query_ret['hits']['total']['value']
 
-                if total_hits < query['query_setting']['page_size']:
+                if page_num * query['query_setting']['page_size'] >= total_hits:
                     next_exist = False
                     print(
                         f'The query returns {total_hits} hits, cannot query the next page')
@@ -334,6 +740,149 @@ class ESClient(Elasticsearch):
                 print(f'Error: {e}')
                 return (0, False)
 
+    #
+    # ==================== query_page_cursor ====================
+    #
+    def query_page_cursor(self, query_id, cursor=None, page_size=None, keep_alive='1m'):
+        '''Query a page of a stored query with point in time and search_after
+        Unlike query_page, the cost of a page does not grow with its depth and pages past
+        index.max_result_window can be read.
+        [in] query_id: id of the query to run
+        [in] cursor: cursor returned with the previous page, None for the first page
+        [in] page_size: number of hits per page. Default is the page size of the query
+        [in] keep_alive: how long the point in time is kept open between two pages
+        [ret] ( total_query_hits, hits, next_cursor ). next_cursor is None after the last page
+
+        Example:
+        total, hits, cursor = es.query_page_cursor(1)
+        while cursor is not None:
+            total, hits, cursor = es.query_page_cursor(1, cursor)
+        '''
+        query = self._stored_query(query_id)
+        if query is None:
+            return (0, [], None)
+        if page_size is None:
+            page_size = query['query_setting']['page_size']
+
+        pit_id = None
+        try:
+            if cursor is None:
+                pit_id = self.open_point_in_time(index=query['index'], keep_alive=keep_alive)['id']
+                search_after = None
+            else:
+                pit_id, search_after = QueryBuilder.decode_cursor(cursor)
+            body = QueryBuilder.pit_page_query(query, page_size, pit_id, keep_alive, search_after)
+            ret = self.timed('search').search(body=body)
+            pit_id = ret.get('pit_id', pit_id)
+            hits = ret['hits']['hits']
+            total_hits = ret['hits']['total']['value']
+        except Exception as e:
+            print(f'Error: {e}')
+            self._close_pit(pit_id)
+            return (0, [], None)
+
+        if len(hits) < page_size:
+            self._close_pit(pit_id)
+            return (total_hits, hits, None)
+        return (total_hits, hits, QueryBuilder.encode_cursor(pit_id, hits[-1]['sort']))
+
+    #
+    # ==================== iter_query_hits ====================
+    #
+    def iter_query_hits(self, query_id, page_size=1000, keep_alive='1m'):
+        '''Stream every hit of a stored query with point in time and search_after
+        [in] query_id: id of the query to run
+        [in] page_size: number of hits fetched per request
+        [in] keep_alive: how long the point in time is kept open between two requests
+        [ret] generator of hits
+        '''
+        query = self._stored_query(query_id)
+        if query is None:
+            return
+
+        pit_id = self.open_point_in_time(index=query['index'], keep_alive=keep_alive)['id']
+        search_after = None
+        try:
+            while True:
+                body = QueryBuilder.pit_page_query(query, page_size, pit_id, keep_alive, search_after)
+                ret = self.timed('search').search(body=body)
+                pit_id = ret.get('pit_id', pit_id)
+                hits = ret['hits']['hits']
+                yield from hits
+                if len(hits) < page_size:
+                    break
+                search_after = hits[-1]['sort']
+        finally:
+            self._close_pit(pit_id)
+
+    #
+    # ==================== _close_pit ====================
+    #
+    def _close_pit(self, pit_id):
+        '''Close a point in time, ignoring errors'''
+        if pit_id is None:
+            return
+        try:
+            if elasticsearch.__version__[0] < 8:
+                self.close_point_in_time(body={"id": pit_id})
+            else:
+                self.close_point_in_time(id=pit_id)
+        except Exception as e:
+            print(f'Error: {e}')
+
+    #
+    # ==================== query_batch ====================
+    #
+    def query_batch(self, query_ids=None, queries_per_request=50, max_workers=4):
+        '''Run many stored queries with a few _msearch requests
+        [in] query_ids: ids of the queries to run. Default is all loaded queries
+        [in] queries_per_request: number of queries sent in one _msearch request
+        [in] max_workers: number of _msearch requests in flight at once
+        [ret] dict keyed by query id of ( total_query_hits, total_pages, hits )
+        '''
+        if self.queries is None:
+            print('Queries not loaded. Please load the query from json file first!')
+            return {}
+        if query_ids is None:
+            query_ids = list(self.queries_by_id)
+        queries = [query for query in map(self._stored_query, query_ids) if query is not None]
+        chunks = [queries[i:i + queries_per_request]
+                  for i in range(0, len(queries), queries_per_request)]
+
+        def run(chunk):
+            try:
+                searches = QueryBuilder.msearch_body(chunk)
+                if elasticsearch.__version__[0] < 8:
+                    ret = self.timed('search').msearch(body=searches)
+                else:
+                    ret = self.timed('search').msearch(searches=searches)
+                return QueryBuilder.parse_msearch(chunk, ret['responses'])
+            except Exception as e:
+                print(f'Error: {e}')
+                return {query['query_id']: (0, 0, []) for query in chunk}
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk_results in executor.map(run, chunks):
+                results.update(chunk_results)
+        return results
+
+    #
+    # ==================== _stored_query ====================
+    #
+    def _stored_query(self, query_id):
+        '''Find a loaded query by id
+        [in] query_id: id of the query
+        [ret] the query, or None if the queries are not loaded or the id is unknown
+        '''
+        if self.queries is None:
+            print('Queries not loaded. Please load the query from json file first!')
+            return None
+        query = self.queries_by_id.get(query_id)
+        if query is None:
+            print(f'Query {query_id} not found')
+        return query
+
     #
     # ==================== get_docs ====================
     #
@@ -345,8 +894,8 @@ class ESClient(Elasticsearch):
         [ret] list of documents
         '''
         try:
-            ret = self.search(index=index_name, body={
-                              "from": offset, "size": size, "query": {"match_all": {}}})
+            ret = self.timed('search').search(index=index_name, body={
+                "from": offset, "size": size, "query": {"match_all": {}}})
             if ret:
                 return ret['hits']['hits']
             else:
@@ -358,27 +907,27 @@ class ESClient(Elasticsearch):
     #
     # ==================== match_filter ====================
     #
-    def match_filter(self, index_name, field_name, match_term):
+    def match_filter(self, index_name, field_name, match_term, count_mode=None, track_total_hits=True):
         '''Match query
         [in] index_name: name of the index to query
         [in] field_name: name of the field to match
         [in] match_term: term to match
+        [in] count_mode: None to run a full search, 'search' to only count with a size 0
+             search in filter context, 'count' to use the _count API
+        [in] track_total_hits: in 'search' count mode, True to count all hits, or the number
+             of hits to count up to
         [ret] total number of hits
         '''
+        if count_mode is not None:
+            return self._count_filter(index_name, QueryBuilder.filter_clause('match', field_name, match_term),
+                                      count_mode, track_total_hits)
+
         # Build query body
-        query_body = {
-            "query": {
-                "bool": {
-                    "match": {
-                        field_name: match_term
-                    }
-                }
-            }
-        }
+        query_body = QueryBuilder.match_query(field_name, match_term)
 
         # Query
         try:
-            self.query_ret = self.search(index=index_name, body=query_body)
+            self.query_ret = self._search(index_name, query_body)
             total_hits = self.query_ret['hits']['total']['value']
             return total_hits
         except Exception as e:
@@ -388,27 +937,27 @@ class ESClient(Elasticsearch):
     #
     # ==================== term_filter ====================
     #
-    def term_filter(self, index_name, field_name, term_term):
+    def term_filter(self, index_name, field_name, term_term, count_mode=None, track_total_hits=True):
         '''Term query
         [in] index_name: name of the index to query
         [in] field_name: name of the field to match
         [in] term_term: term to match
+        [in] count_mode: None to run a full search, 'search' to only count with a size 0
+             search in filter context, 'count' to use the _count API
+        [in] track_total_hits: in 'search' count mode, True to count all hits, or the number
+             of hits to count up to
         [ret] total number of hits
         '''
+        if count_mode is not None:
+            return self._count_filter(index_name, QueryBuilder.filter_clause('term', field_name, term_term),
+                                      count_mode, track_total_hits)
+
         # Build query body
-        query_body = {
-            "query": {
-                "bool": {
-                    "term": {
-                        field_name: term_term
-                    }
-                }
-            }
-        }
+        query_body = QueryBuilder.term_query(field_name, term_term)
 
         # Query
         try:
-            self.query_ret = self.search(index=index_name, body=query_body)
+            self.query_ret = self._search(index_name, query_body)
             total_hits = self.query_ret['hits']['total']['value']
             return total_hits
         except Exception as e:
@@ -419,31 +968,28 @@ class ESClient(Elasticsearch):
     #
     # ==================== range_filter ====================
     #
-    def range_filter(self, index_name, field_name, minimum, maximum):
+    def range_filter(self, index_name, field_name, minimum, maximum, count_mode=None, track_total_hits=True):
         '''Range query
         [in] index_name: name of the index to query
         [in] field_name: name of the field to match
         [in] minimum: minimum value of the range
         [in] maximum: maximum value of the range
+        [in] count_mode: None to run a full search, 'search' to only count with a size 0
+             search in filter context, 'count' to use the _count API
+        [in] track_total_hits: in 'search' count mode, True to count all hits, or the number
+             of hits to count up to
         [ret] total number of hits
         '''
+        if count_mode is not None:
+            return self._count_filter(index_name, QueryBuilder.filter_clause('range', field_name, minimum, maximum),
+                                      count_mode, track_total_hits)
+
         # Build query body
-        query_body = {
-            "query": {
-                "bool": {
-                    "range": {
-                        field_name: {
-                            "gte": minimum,
-                            "lte": maximum
-                        }
-                    }
-                }
-            }
-        }
+        query_body = QueryBuilder.range_query(field_name, minimum, maximum)
 
         # Query
         try:
-            self.query_ret = self.search(index=index_name, body=query_body)
+            self.query_ret = self._search(index_name, query_body)
             total_hits = self.query_ret['hits']['total']['value']
             return total_hits
         except Exception as e:
@@ -451,6 +997,133 @@ class ESClient(Elasticsearch):
             return 0
 
     
+    #
+    # ==================== knn_search ====================
+    #
+    def knn_search(self, index_name, query_text, doc_emb, k=10, num_candidates=100, field='vector',
+                   filter=None, source=None):
+        '''Approximate kNN search on a dense_vector field with the embedding of a text
+        [in] index_name: name of the index to query
+        [in] query_text: raw query text, tokenized and embedded with doc_emb
+        [in] doc_emb: DocEmb of the model used to embed the documents at ingestion
+        [in] k: number of nearest neighbours to return
+        [in] num_candidates: number of candidates considered per shard. Higher is more accurate and slower
+        [in] field: name of the dense_vector field
+        [in] filter: optional query clause restricting the documents searched
+        [in] source: optional list of fields to return. Default returns the whole _source
+        [ret] list of hits, best first
+        '''
+        query_body = QueryBuilder.knn_query(doc_emb(tokenize(query_text)).tolist(), k, num_candidates,
+                                            field, filter, source)
+        try:
+            self.query_ret = self._search(index_name, query_body)
+            return self.query_ret['hits']['hits']
+        except Exception as e:
+            print(f'Error: {e}')
+            return []
+
+    #
+    # ==================== hybrid_search ====================
+    #
+    def hybrid_search(self, index_name, field_names, query_text, doc_emb, k=10, lexical_depth=50,
+                      vector_depth=50, num_candidates=100, fusion='rrf', rrf_k=60, weights=None,
+                      operator='OR', vector_field='vector'):
+        '''Hybrid lexical + vector search
+        A query_string search and a kNN search on the embedding of the query run concurrently,
+        and their hits are merged on the client, so the latency is the one of the slower search.
+        [in] index_name: name of the index to query
+        [in] field_names: text fields of the lexical search. E.g. ['title', 'content']
+        [in] query_text: raw query text
+        [in] doc_emb: DocEmb of the model used to embed the documents at ingestion
+        [in] k: number of fused hits to return
+        [in] lexical_depth: number of hits of the lexical search to fuse
+        [in] vector_depth: number of hits of the kNN search to fuse
+        [in] num_candidates: number of kNN candidates considered per shard
+        [in] fusion: 'rrf' for reciprocal rank fusion, 'weighted' for a weighted sum of
+             min-max normalized scores
+        [in] rrf_k: rank constant of reciprocal rank fusion
+        [in] weights: ( lexical weight, vector weight ). Default is (1, 1)
+        [in] operator: operator of the lexical search, 'AND' or 'OR'
+        [in] vector_field: name of the dense_vector field
+        [ret] list of hits, best first, with the fused score in _fused_score and the rank in
+              the ( lexical, vector ) searches in _ranks
+        '''
+        if fusion not in ['rrf', 'weighted']:
+            print('Invalid fusion')
+            return []
+        lexical_body = QueryBuilder.query_strings_query(field_names, operator, False, [query_text])
+        if lexical_body is None:
+            return []
+        lexical_body['size'] = lexical_depth
+
+        def lexical():
+            return self._search(index_name, lexical_body)['hits']['hits']
+
+        def vector():
+            query_body = QueryBuilder.knn_query(doc_emb(tokenize(query_text)).tolist(), vector_depth,
+                                                num_candidates, vector_field)
+            return self._search(index_name, query_body)['hits']['hits']
+
+        try:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                lexical_hits = executor.submit(lexical)
+                vector_hits = executor.submit(vector)
+                ranked_lists = [lexical_hits.result(), vector_hits.result()]
+        except Exception as e:
+            print(f'Error: {e}')
+            return []
+
+        if fusion == 'rrf':
+            return Fusion.reciprocal_rank_fusion(ranked_lists, k=rrf_k, weights=weights, size=k)
+        return Fusion.weighted_score_fusion(ranked_lists, weights=weights, size=k)
+
+    #
+    # ==================== count_filters ====================
+    #
+    def count_filters(self, index_name, filters):
+        '''Count the documents matching each of many filters with a single request
+        [in] index_name: name of the index to query
+        [in] filters: dict of filters keyed by name. Each filter is a tuple of
+             ('match' | 'term', field_name, term) or ('range', field_name, minimum, maximum)
+        [ret] dict of the number of matching documents keyed by filter name
+
+        Example:
+        counts = es.count_filters('article', {
+            'vnexpress': ('term', 'domain', 'vnexpress.net'),
+            'covid': ('match', 'title', 'covid'),
+            '2023': ('range', 'created_date', '2023-01-01', '2023-12-31')})
+        '''
+        clauses = {name: QueryBuilder.filter_clause(*spec) for name, spec in filters.items()}
+        if None in clauses.values():
+            return {name: 0 for name in filters}
+
+        try:
+            ret = self._search(index_name, QueryBuilder.filters_count_query(clauses))
+            buckets = ret['aggregations']['counts']['buckets']
+            return {name: buckets[name]['doc_count'] for name in filters}
+        except Exception as e:
+            print(f'Error: {e}')
+            return {name: 0 for name in filters}
+
+    #
+    # ==================== _count_filter ====================
+    #
+    def _count_filter(self, index_name, clause, count_mode, track_total_hits):
+        '''Count the documents matching a clause without scoring or fetching hits
+        [ret] number of matching documents
+        '''
+        if clause is None:
+            return 0
+        try:
+            if count_mode == 'count':
+                body = {"query": {"bool": {"filter": [clause]}}}
+                return self.timed('search').count(index=index_name, body=body)['count']
+            ret = self._search(index_name, QueryBuilder.count_query(clause, track_total_hits))
+            return ret['hits']['total']['value']
+        except Exception as e:
+            print(f'Error: {e}')
+            return 0
+
     #
     # ==================== query_strings ====================
     #
@@ -470,50 +1143,15 @@ class ESClient(Elasticsearch):
         hits = es.get( 'query_ret', {} )
         '''
         # Build query body        
-        if len(phrases) == 0:
-            print('No phrase')
+        query_body = QueryBuilder.query_strings_query(field_names, operator, highlight, phrases)
+        if query_body is None:
             return 0
 
-        if operator not in ['AND', 'OR', 'NOR']:
-            print('Invalid operator')
-            return 0
-        
-        if operator == 'NOR':
-            query_body = {
-                "query": {
-                    "bool": {
-                        "query_string": {
-                            "fields": field_names,
-                            "query": f"NOT({' '.join( f'({phrase})' for phrase in phrases )})"
-                        }
-                    }
-                }
-            }
-        else:
-            query_body = {
-                "query": {
-                    "bool": {
-                        "query_string": {
-                            "fields": field_names,
-                            "default_operator": operator,
-                            "query": ' '.join( f'({phrase})' for phrase in phrases )
-                        }
-                    }
-                }
-            }
-        
-        if highlight:
-            query_body['highlight'] = {
-                "fields": {
-                    "*": {}
-                }
-            }
-
         # Query
         try:
-            self.query_ret = self.search(index = index_name, body = query_body)
+            self.query_ret = self._search(index_name, query_body)
             total_hits = self.query_ret['hits']['total']['value']
             return total_hits
         except Exception as e:
             print(f'Error: {e}')
-            return 0
\ No newline at end of file
+            return 0
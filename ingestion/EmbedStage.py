@@ -0,0 +1,105 @@
+import gensim.utils
+
+
+def tokenize(text):
+    '''Tokenize a text the way the Doc2Vec training corpus is tokenized'''
+    return gensim.utils.to_unicode(text).split()
+
+
+def vector_mapping(dims, quantization=None, similarity='cosine', m=16, ef_construction=100):
+    '''Mapping of an HNSW-indexed dense_vector field
+    [in] dims: number of dimensions, the vector_size of the Doc2Vec model
+    [in] quantization: None or 'float32' to keep float vectors in the HNSW graph, 'int8' to
+         let Elasticsearch quantize them to int8 (int8_hnsw, about 4x less memory).
+         Elasticsearch has no float16 vectors, so 'float16' keeps float vectors
+    [in] similarity: 'cosine', 'dot_product', 'l2_norm' or 'max_inner_product'
+    [in] m: number of neighbours of each node of the HNSW graph
+    [in] ef_construction: number of candidates considered when building the graph
+    '''
+    index_type = 'hnsw'
+    if quantization == 'int8':
+        index_type = 'int8_hnsw'
+    elif quantization == 'float16':
+        print('Elasticsearch has no float16 vectors, the field keeps float vectors')
+    elif quantization not in [None, 'float32']:
+        print(f'Invalid quantization {quantization}, the field keeps float vectors')
+    return {
+        "type": "dense_vector",
+        "dims": dims,
+        "index": True,
+        "similarity": similarity,
+        "index_options": {"type": index_type, "m": m, "ef_construction": ef_construction}
+    }
+
+
+class EmbedStage:
+    '''Ingestion stage writing a dense vector embedding of each record
+    A stage is called with a list of records and returns the list of records to ingest.
+    The text of the source fields is tokenized and embedded in batches with DocEmb.
+    With worker processes, the pool is started once, when the stage is created: create the
+    stage before the ingestion, so the workers are forked before the bulk threads start,
+    and close it when done.
+
+    Example:
+    stage = EmbedStage(DocEmb(model), field='vector', source_fields=['title', 'content'])
+    es.ingest_bulk_from_csv('article', 'articles.csv', stages=[stage])
+
+    with EmbedStage(DocEmb(model), workers=8) as stage:
+        es.ingest_bulk_from_csv_stream('article', 'articles.csv', stages=[stage])
+    '''
+
+    def __init__(self, doc_emb, field='vector', source_fields=('title', 'content'), tokenizer=tokenize,
+                 **batch_options):
+        '''
+        [in] doc_emb: DocEmb (or CachedDocEmb) used to embed the records
+        [in] field: name of the dense_vector field to write
+        [in] source_fields: fields whose text is concatenated and embedded
+        [in] tokenizer: function splitting a text into tokens
+        [in] batch_options: options of DocEmb.embed_batch, e.g. workers and chunk_size.
+             Default embeds in the current process
+        '''
+        self.doc_emb = doc_emb
+        self.field = field
+        self.source_fields = list(source_fields)
+        self.tokenizer = tokenizer
+        self.batch_options = batch_options
+        self._pool = None
+        if batch_options and batch_options.get('workers') != 1:
+            self._pool = doc_emb.pool(batch_options.get('workers'))
+            self.batch_options = dict(batch_options, pool=self._pool)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Stop the worker processes'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self.batch_options = {key: value for key, value in self.batch_options.items() if key != 'pool'}
+
+    @classmethod
+    def from_profile(cls, doc_emb, index_config, **batch_options):
+        '''Create the stage from the embedding section of an index configuration of the profile
+        [in] doc_emb: DocEmb used to embed the records
+        [in] index_config: one entry of profile['indices'], with an embedding section
+        '''
+        embedding = index_config['embedding']
+        return cls(doc_emb, field=embedding['field'], source_fields=embedding['source_fields'],
+                   **batch_options)
+
+    def __call__(self, records):
+        docs = [self.tokenizer(' '.join(str(record.get(field) or '') for field in self.source_fields))
+                for record in records]
+        if self.batch_options:
+            vectors = [vector for chunk in self.doc_emb.embed_batch(docs, **self.batch_options)
+                       for vector in chunk]
+        else:
+            vectors = self.doc_emb.embed_many(docs)
+        for record, vector in zip(records, vectors):
+            record[self.field] = vector.tolist()
+        return records
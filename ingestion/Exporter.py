@@ -0,0 +1,151 @@
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ESClient import ESClient
+
+
+# Arrow types of the Elasticsearch field types. Other types are exported as JSON strings
+ARROW_TYPES = {
+    'keyword': pa.string(),
+    'text': pa.string(),
+    'date': pa.string(),
+    'long': pa.int64(),
+    'integer': pa.int64(),
+    'short': pa.int64(),
+    'byte': pa.int64(),
+    'double': pa.float64(),
+    'float': pa.float64(),
+    'half_float': pa.float64(),
+    'boolean': pa.bool_(),
+    'dense_vector': pa.list_(pa.float32()),
+}
+
+
+#
+# ==================== export_index ====================
+#
+def export_index(path_to_profile, index_name, out_dir, fmt='parquet', slices=4, page_size=1000,
+                 chunk_rows=50000, keep_alive='5m'):
+    '''Export the _source of a whole index to Parquet or Arrow files
+    The index is read through one point in time split into slices, each slice read by its own
+    worker process with search_after and written to its own file, chunk_rows rows at a time,
+    so the memory of a worker stays bounded whatever the index size.
+    [in] path_to_profile: profile used by each worker to connect to Elasticsearch
+    [in] index_name: name of the index to export
+    [in] out_dir: directory to write the files to, one file per slice
+    [in] fmt: 'parquet' or 'arrow' (Arrow IPC file)
+    [in] slices: number of slices, and worker processes
+    [in] page_size: number of documents fetched per request
+    [in] chunk_rows: number of rows buffered before they are written as one row group / batch
+    [in] keep_alive: how long the point in time is kept open between two requests
+    [ret] list of per-slice summaries with the file path, number of rows and seconds
+    '''
+    if fmt not in ['parquet', 'arrow']:
+        print(f'Invalid format {fmt}')
+        return []
+    os.makedirs(out_dir, exist_ok=True)
+
+    es = ESClient(path_to_profile)
+    scheme = es.indices.get_mapping(index=index_name)[index_name]['mappings']['properties']
+    field_types = {field: config.get('type', 'object') for field, config in scheme.items()}
+    pit_id = es.open_point_in_time(index=index_name, keep_alive=keep_alive)['id']
+
+    start = time.perf_counter()
+    tasks = [(path_to_profile, pit_id, slice_id, slices, field_types,
+              os.path.join(out_dir, f'{index_name}-{slice_id:03d}.{fmt}'), fmt, page_size, chunk_rows,
+              keep_alive)
+             for slice_id in range(slices)]
+    try:
+        with Pool(processes=slices) as pool:
+            summary = pool.starmap(_export_slice, tasks)
+    finally:
+        es._close_pit(pit_id)
+        es.close()
+
+    seconds = time.perf_counter() - start
+    rows = sum(part['rows'] for part in summary)
+    print(f'Exported {rows} documents of {index_name} in {seconds:.1f}s ({rows / seconds:.0f} docs/sec)')
+    return summary
+
+
+#
+# ==================== arrow_schema ====================
+#
+def arrow_schema(field_types):
+    '''Build the Arrow schema of an export
+    [in] field_types: dict of Elasticsearch field types keyed by field name
+    [ret] schema with an _id column followed by the fields
+    '''
+    return pa.schema([('_id', pa.string())] +
+                     [(field, ARROW_TYPES.get(es_type, pa.string())) for field, es_type in field_types.items()])
+
+
+#
+# ==================== _export_slice ====================
+#
+def _export_slice(path_to_profile, pit_id, slice_id, slices, field_types, path, fmt, page_size,
+                  chunk_rows, keep_alive):
+    '''Read one slice of a point in time and write it to one file'''
+    start = time.perf_counter()
+    es = ESClient(path_to_profile)
+    schema = arrow_schema(field_types)
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+
+    rows = 0
+    chunk = []
+    search_after = None
+    try:
+        while True:
+            body = {
+                "size": page_size,
+                "query": {"match_all": {}},
+                "pit": {"id": pit_id, "keep_alive": keep_alive},
+                "sort": [{"_shard_doc": "asc"}]
+            }
+            if slices > 1:
+                body['slice'] = {"id": slice_id, "max": slices}
+            if search_after is not None:
+                body['search_after'] = search_after
+            hits = es.search(body=body)['hits']['hits']
+
+            chunk.extend(hits)
+            if len(chunk) >= chunk_rows:
+                writer.write_table(_to_table(chunk, schema))
+                rows += len(chunk)
+                chunk = []
+            if len(hits) < page_size:
+                break
+            search_after = hits[-1]['sort']
+
+        if chunk:
+            writer.write_table(_to_table(chunk, schema))
+            rows += len(chunk)
+    finally:
+        writer.close()
+        es.close()
+
+    return {'slice': slice_id, 'path': path, 'rows': rows, 'seconds': time.perf_counter() - start}
+
+
+#
+# ==================== _to_table ====================
+#
+def _to_table(hits, schema):
+    '''Convert search hits to an Arrow table with the export schema'''
+    columns = {'_id': [hit['_id'] for hit in hits]}
+    for field in schema.names[1:]:
+        values = [hit['_source'].get(field) for hit in hits]
+        if schema.field(field).type == pa.string():
+            # arrays and objects do not fit a string column, keep them as JSON
+            values = [value if value is None or isinstance(value, str) else json.dumps(value)
+                      for value in values]
+        columns[field] = values
+    return pa.Table.from_pydict(columns, schema=schema)
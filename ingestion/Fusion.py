@@ -0,0 +1,58 @@
+'''Client-side fusion of ranked hit lists, e.g. of a lexical and a vector search'''
+
+
+#
+# ==================== reciprocal_rank_fusion ====================
+#
+def reciprocal_rank_fusion(ranked_lists, k=60, weights=None, size=None):
+    '''Merge ranked lists of hits by reciprocal rank fusion
+    The score of a document is the sum over the lists of weight / (k + rank), rank starting
+    at 1. Only ranks are used, so lists with incomparable scores can be merged.
+    [in] ranked_lists: list of lists of hits, best first. Hits are identified by _id
+    [in] k: rank constant. Higher values flatten the contribution of the top ranks
+    [in] weights: weight of each list. Default is 1 for all
+    [in] size: number of fused hits to return. Default returns all
+    [ret] list of hits, best first, see _merge
+    '''
+    weights = weights or [1.0] * len(ranked_lists)
+    return _merge(ranked_lists, size, lambda rank, score, leg: weights[leg] / (k + rank))
+
+
+#
+# ==================== weighted_score_fusion ====================
+#
+def weighted_score_fusion(ranked_lists, weights=None, size=None):
+    '''Merge ranked lists of hits by a weighted sum of their min-max normalized scores
+    [in] ranked_lists: list of lists of hits with _id and _score, best first
+    [in] weights: weight of each list. Default is 1 for all
+    [in] size: number of fused hits to return. Default returns all
+    [ret] list of hits, best first, see _merge
+    '''
+    weights = weights or [1.0] * len(ranked_lists)
+    bounds = []
+    for hits in ranked_lists:
+        scores = [hit['_score'] or 0.0 for hit in hits]
+        bounds.append((min(scores), max(scores)) if scores else (0.0, 0.0))
+
+    def contribution(rank, score, leg):
+        low, high = bounds[leg]
+        return weights[leg] * ((score or 0.0) - low) / (high - low) if high > low else weights[leg]
+
+    return _merge(ranked_lists, size, contribution)
+
+
+def _merge(ranked_lists, size, contribution):
+    '''Sum the contributions of each list to each document
+    [ret] list of hits, best first. Each hit is the first hit seen with its _id, with the
+          fused score in _fused_score and its rank in each list (None if absent) in _ranks
+    '''
+    fused = {}
+    for leg, hits in enumerate(ranked_lists):
+        for rank, hit in enumerate(hits, start=1):
+            if hit['_id'] not in fused:
+                fused[hit['_id']] = dict(hit, _fused_score=0.0, _ranks=[None] * len(ranked_lists))
+            entry = fused[hit['_id']]
+            entry['_fused_score'] += contribution(rank, hit.get('_score'), leg)
+            entry['_ranks'][leg] = rank
+    ranked = sorted(fused.values(), key=lambda hit: hit['_fused_score'], reverse=True)
+    return ranked if size is None else ranked[:size]
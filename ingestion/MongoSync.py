@@ -0,0 +1,231 @@
+import datetime
+import os
+import time
+
+from bson import ObjectId, json_util
+
+from BulkIngester import BulkIngester
+
+
+#
+# ==================== to_record ====================
+#
+def to_record(doc):
+    '''Convert a MongoDB document to a JSON serializable record
+    ObjectIds become strings and datetimes ISO 8601 strings, in nested documents and lists too.
+    '''
+    if isinstance(doc, dict):
+        return {key: to_record(value) for key, value in doc.items()}
+    if isinstance(doc, (list, tuple)):
+        return [to_record(value) for value in doc]
+    if isinstance(doc, ObjectId):
+        return str(doc)
+    if isinstance(doc, (datetime.datetime, datetime.date)):
+        return doc.isoformat()
+    return doc
+
+
+class MongoSync:
+    '''Incremental sync of a MongoDB collection to an Elasticsearch index
+    Only the documents changed since the last run are read, either by watermark: documents
+    with an updated-at field (ties broken by _id) after the last synced one, or by change
+    stream: the changes after the last resume token. The MongoDB _id is the Elasticsearch
+    document id, so writes are upserts and syncing the same change twice is harmless.
+    The position is saved to a JSON checkpoint after each batch is acknowledged by
+    Elasticsearch, so a restarted sync picks up where it stopped.
+
+    The collection is only used through find (watermark) or watch (change stream), so a
+    local stand-in, e.g. a mongomock collection, can replace a MongoDB server.
+
+    Example:
+    sync = MongoSync(MongoClient(uri)['news']['article'], es, 'article', 'article.sync.json')
+    stats = sync.run()
+    '''
+
+    def __init__(self, collection, client, index_name, checkpoint_path, mode='watermark',
+                 updated_field='updated_at', deleted_field=None, batch_size=5000, stages=(),
+                 max_await_ms=1000, **bulk_options):
+        '''
+        [in] collection: pymongo collection (or stand-in) to read the documents from
+        [in] client: Elasticsearch client used to send the bulk requests
+        [in] index_name: name of the index to sync the documents to
+        [in] checkpoint_path: JSON file of the sync position
+        [in] mode: 'watermark' or 'change_stream'. Change streams need a replica set
+        [in] updated_field: field holding the last update time, for the watermark mode.
+             Documents where it is missing or null are not synced
+        [in] deleted_field: optional soft-delete flag. In the watermark mode, documents with
+             a true flag are deleted from the index
+        [in] batch_size: number of documents read and checkpointed at a time
+        [in] stages: ingestion stages applied to each batch, see ESClient.ingest_bulk_from_list.
+             Records keep their _id while staged
+        [in] max_await_ms: in the change stream mode, how long to wait for new changes
+             before the run ends
+        [in] bulk_options: options of BulkIngester, e.g. workers, max_retries, dead_letter_path.
+             Documents failing for good are written to the dead-letter file, by default
+             <index_name>.dead_letter.ndjson, and the sync goes on. With dead_letter_path=None,
+             the sync stops before their batch, to read them again on the next run
+        '''
+        if mode not in ('watermark', 'change_stream'):
+            raise ValueError(f'Unknown sync mode {mode}')
+        self.collection = collection
+        self.client = client
+        self.index_name = index_name
+        self.checkpoint_path = checkpoint_path
+        self.mode = mode
+        self.updated_field = updated_field
+        self.deleted_field = deleted_field
+        self.batch_size = batch_size
+        self.stages = stages
+        self.max_await_ms = max_await_ms
+        self.bulk_options = bulk_options
+
+    #
+    # ==================== checkpoint ====================
+    #
+    def load_checkpoint(self):
+        '''Get the saved sync position
+        [ret] dict with the watermark (updated_at, _id) or the change stream resume_token.
+              Empty if the collection was never synced
+        '''
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as f:
+            # extended JSON keeps the datetimes and ObjectIds of the watermark
+            return json_util.loads(f.read())
+
+    def save_checkpoint(self, checkpoint):
+        '''Save the sync position atomically, so a crash leaves either the old or the new one'''
+        with open(self.checkpoint_path + '.tmp', 'w') as f:
+            f.write(json_util.dumps(checkpoint))
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    #
+    # ==================== run ====================
+    #
+    def run(self):
+        '''Sync the changes since the last checkpoint
+        [ret] dict with the number of batches, upserted, deleted and failed documents, elapsed
+              seconds and the last checkpoint
+        '''
+        stats = {'batches': 0, 'upserted': 0, 'deleted': 0, 'failed': 0}
+        start = time.perf_counter()
+        checkpoint = self.load_checkpoint()
+        batches = self._watermark_batches(checkpoint) if self.mode == 'watermark' \
+            else self._change_stream_batches(checkpoint)
+        try:
+            for upserts, deletes, checkpoint in batches:
+                upserted, deleted, summary = self._send(upserts, deletes)
+                failed = sum(batch['failed'] - batch['dead_lettered'] for batch in summary)
+                stats['batches'] += 1
+                stats['upserted'] += upserted
+                stats['deleted'] += deleted
+                stats['failed'] += sum(batch['failed'] for batch in summary)
+                if failed > 0:
+                    # the documents are neither in the index nor in a dead-letter file:
+                    # keep the checkpoint so the next run reads them again
+                    print(f'Error: {failed} documents failed, sync stopped before {checkpoint}')
+                    break
+                self.save_checkpoint(checkpoint)
+        finally:
+            batches.close()
+            if hasattr(self.client, '_invalidate'):
+                # ESClient response cache
+                self.client._invalidate(self.index_name)
+
+        stats['seconds'] = time.perf_counter() - start
+        stats['checkpoint'] = self.load_checkpoint()
+        print(f'Synced {stats["upserted"]} upserts and {stats["deleted"]} deletes to {self.index_name} '
+              f'in {stats["batches"]} batches ({stats["seconds"]:.1f}s)')
+        return stats
+
+    #
+    # ==================== _send ====================
+    #
+    def _send(self, upserts, deletes):
+        '''Send one batch of changes and wait for Elasticsearch to acknowledge it
+        [ret] ( number of upserts indexed, number of deletes indexed, per-batch summaries of BulkIngester )
+        '''
+        for stage in self.stages:
+            upserts = stage(upserts)
+        with BulkIngester(self.client, self.index_name, **self.bulk_options) as ingester:
+            for record in upserts:
+                doc_id = record.pop('_id')
+                ingester.add(record, doc_id=doc_id)
+        upsert_summary = ingester.summary
+        with BulkIngester(self.client, self.index_name, **self.bulk_options) as ingester:
+            for doc_id in deletes:
+                ingester.add(None, doc_id=doc_id, op='delete')
+        delete_summary = ingester.summary
+        return (sum(batch['indexed'] for batch in upsert_summary),
+                sum(batch['indexed'] for batch in delete_summary),
+                upsert_summary + delete_summary)
+
+    #
+    # ==================== _watermark_batches ====================
+    #
+    def _watermark_batches(self, checkpoint):
+        '''Read the documents updated after the watermark, in (updated_at, _id) order
+        [ret] generator of ( upserts, deleted ids, checkpoint after the batch )
+        '''
+        field = self.updated_field
+        # documents without an update time cannot be ordered against the watermark: a null
+        # watermark would match no timestamp on the next run
+        timestamped = {field: {'$exists': True, '$ne': None}}
+        missing = self.collection.count_documents({field: None})
+        if missing > 0:
+            print(f'Error: {missing} documents have no {field} and are not synced')
+        while True:
+            query = timestamped
+            if checkpoint.get('updated_at') is not None:
+                watermark, last_id = checkpoint['updated_at'], checkpoint['_id']
+                # documents updated in the same instant as the last one are told apart by _id
+                query = {'$and': [timestamped, {'$or': [{field: {'$gt': watermark}},
+                                                        {field: watermark, '_id': {'$gt': last_id}}]}]}
+            docs = list(self.collection.find(query, sort=[(field, 1), ('_id', 1)], limit=self.batch_size))
+            if not docs:
+                return
+
+            upserts, deletes = [], []
+            for doc in docs:
+                if self.deleted_field is not None and doc.get(self.deleted_field):
+                    deletes.append(str(doc['_id']))
+                else:
+                    upserts.append(dict(to_record(doc), _id=str(doc['_id'])))
+            checkpoint = {'updated_at': docs[-1][field], '_id': docs[-1]['_id']}
+            yield upserts, deletes, checkpoint
+            if len(docs) < self.batch_size:
+                return
+
+    #
+    # ==================== _change_stream_batches ====================
+    #
+    def _change_stream_batches(self, checkpoint):
+        '''Read the changes after the resume token, until none arrives for max_await_ms
+        [ret] generator of ( upserts, deleted ids, checkpoint after the batch )
+        '''
+        options = {'full_document': 'updateLookup', 'max_await_time_ms': self.max_await_ms}
+        if checkpoint.get('resume_token') is not None:
+            options['resume_after'] = checkpoint['resume_token']
+        with self.collection.watch(**options) as stream:
+            while True:
+                # upserts keyed by id, so only the last change of a document is sent
+                upserts, deletes = {}, {}
+                count = 0
+                while count < self.batch_size:
+                    change = stream.try_next()
+                    if change is None:
+                        break
+                    count += 1
+                    doc_id = str(change['documentKey']['_id'])
+                    if change['operationType'] == 'delete' or (
+                            change['operationType'] in ('insert', 'update', 'replace')
+                            and change.get('fullDocument') is None):
+                        # gone, or deleted again before the update could be looked up
+                        upserts.pop(doc_id, None)
+                        deletes[doc_id] = True
+                    elif change['operationType'] in ('insert', 'update', 'replace'):
+                        deletes.pop(doc_id, None)
+                        upserts[doc_id] = dict(to_record(change['fullDocument']), _id=doc_id)
+                if count == 0:
+                    return
+                yield list(upserts.values()), list(deletes), {'resume_token': stream.resume_token}
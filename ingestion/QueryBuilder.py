@@ -0,0 +1,299 @@
+'''Query bodies shared by ESClient and AsyncESClient'''
+import base64
+import json
+import math
+
+
+#
+# ==================== page_query ====================
+#
+def page_query(query, page_num):
+    '''Build the body of one page of a stored query
+    [in] query: stored query, with query_body and query_setting.page_size
+    [in] page_num: page number, starting at 1
+    [ret] query body with from and size set. The stored query is not modified
+    '''
+    page_size = query['query_setting']['page_size']
+    query_body = dict(query['query_body'])
+    query_body['from'] = (page_num - 1) * page_size
+    query_body['size'] = page_size
+    return query_body
+
+
+#
+# ==================== pit_page_query ====================
+#
+def pit_page_query(query, page_size, pit_id, keep_alive, search_after=None):
+    '''Build the body of one page of a stored query read through a point in time
+    [in] query: stored query
+    [in] page_size: number of hits per page
+    [in] pit_id: id of the point in time
+    [in] keep_alive: how long the point in time is kept open, e.g. '1m'
+    [in] search_after: sort values of the last hit of the previous page, None for the first page
+    [ret] query body sorted with the _shard_doc tiebreaker
+    '''
+    query_body = {key: value for key, value in query['query_body'].items() if key not in ['from', 'size']}
+    sort = query_body.get('sort', [])
+    sort = list(sort) if isinstance(sort, list) else [sort]
+    query_body['sort'] = sort + [{"_shard_doc": "asc"}]
+    query_body['size'] = page_size
+    query_body['pit'] = {"id": pit_id, "keep_alive": keep_alive}
+    if search_after is not None:
+        query_body['search_after'] = search_after
+    return query_body
+
+
+#
+# ==================== encode_cursor ====================
+#
+def encode_cursor(pit_id, search_after):
+    '''Encode the position after a page into an opaque cursor string'''
+    state = json.dumps({"pit": pit_id, "after": search_after}).encode('utf-8')
+    return base64.urlsafe_b64encode(state).decode('ascii')
+
+
+#
+# ==================== decode_cursor ====================
+#
+def decode_cursor(cursor):
+    '''Decode a cursor string
+    [ret] ( pit_id, search_after )
+    '''
+    state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return (state['pit'], state['after'])
+
+
+#
+# ==================== msearch_body ====================
+#
+def msearch_body(queries):
+    '''Build the body of an _msearch request running stored queries
+    [in] queries: list of stored queries
+    [ret] list of alternating header and query body
+    '''
+    searches = []
+    for query in queries:
+        searches.append({"index": query['index']})
+        searches.append(query['query_body'])
+    return searches
+
+
+#
+# ==================== parse_msearch ====================
+#
+def parse_msearch(queries, responses):
+    '''Read the responses of an _msearch request built with msearch_body
+    [in] queries: list of stored queries, in the order they were sent
+    [in] responses: the responses list of the _msearch result
+    [ret] dict keyed by query id of ( total_query_hits, total_pages, hits )
+    '''
+    results = {}
+    for query, ret in zip(queries, responses):
+        if 'error' in ret:
+            print(f'Error in query {query["query_id"]}: {ret["error"]}')
+            results[query['query_id']] = (0, 0, [])
+            continue
+        total_hits = ret['hits']['total']['value']
+        pages = math.ceil(total_hits / query['query_setting']['page_size'])
+        results[query['query_id']] = (total_hits, pages, ret['hits']['hits'])
+    return results
+
+
+#
+# ==================== match_query ====================
+#
+def match_query(field_name, match_term):
+    '''Build a match query body
+    [in] field_name: name of the field to match
+    [in] match_term: term to match
+    '''
+    return {
+        "query": {
+            "bool": {
+                "must": {
+                    "match": {
+                        field_name: match_term
+                    }
+                }
+            }
+        }
+    }
+
+
+#
+# ==================== term_query ====================
+#
+def term_query(field_name, term_term):
+    '''Build a term query body
+    [in] field_name: name of the field to match
+    [in] term_term: term to match
+    '''
+    return {
+        "query": {
+            "bool": {
+                "must": {
+                    "term": {
+                        field_name: term_term
+                    }
+                }
+            }
+        }
+    }
+
+
+#
+# ==================== range_query ====================
+#
+def range_query(field_name, minimum, maximum):
+    '''Build a range query body
+    [in] field_name: name of the field to match
+    [in] minimum: minimum value of the range
+    [in] maximum: maximum value of the range
+    '''
+    return {
+        "query": {
+            "bool": {
+                "must": {
+                    "range": {
+                        field_name: {
+                            "gte": minimum,
+                            "lte": maximum
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+#
+# ==================== query_strings_query ====================
+#
+def query_strings_query(field_names, operator, highlight, phrases):
+    '''Build a query_string query body combining several phrases
+    [in] field_names: field names to search. E.g. ['title', 'content']
+    [in] operator: 'AND', 'OR', 'NOR'
+    [in] highlight: True or False
+    [in] phrases: list of phrases to search
+    [ret] query body, or None if there is no phrase or the operator is invalid
+    '''
+    if len(phrases) == 0:
+        print('No phrase')
+        return None
+
+    if operator not in ['AND', 'OR', 'NOR']:
+        print('Invalid operator')
+        return None
+
+    if operator == 'NOR':
+        query_string = {
+            "fields": field_names,
+            "query": f"NOT({' '.join( f'({phrase})' for phrase in phrases )})"
+        }
+    else:
+        query_string = {
+            "fields": field_names,
+            "default_operator": operator,
+            "query": ' '.join( f'({phrase})' for phrase in phrases )
+        }
+    query_body = {
+        "query": {
+            "bool": {
+                "must": {
+                    "query_string": query_string
+                }
+            }
+        }
+    }
+
+    if highlight:
+        query_body['highlight'] = {
+            "fields": {
+                "*": {}
+            }
+        }
+    return query_body
+
+
+#
+# ==================== filter_clause ====================
+#
+def filter_clause(kind, field_name, *args):
+    '''Build a match, term or range clause
+    [in] kind: 'match', 'term' or 'range'
+    [in] field_name: name of the field to filter on
+    [in] args: term to match, or minimum and maximum of the range
+    [ret] query clause, or None if the kind is invalid
+    '''
+    if kind in ['match', 'term']:
+        return {kind: {field_name: args[0]}}
+    if kind == 'range':
+        return {"range": {field_name: {"gte": args[0], "lte": args[1]}}}
+    print(f'Invalid filter {kind}')
+    return None
+
+
+#
+# ==================== count_query ====================
+#
+def count_query(clause, track_total_hits=True):
+    '''Build a search body that only counts the documents matching a clause
+    The clause runs in filter context, so documents are not scored, and no hit is fetched.
+    [in] clause: query clause, see filter_clause
+    [in] track_total_hits: True to count all hits, or the number of hits to count up to
+    '''
+    return {
+        "size": 0,
+        "track_total_hits": track_total_hits,
+        "query": {
+            "bool": {
+                "filter": [clause]
+            }
+        }
+    }
+
+
+#
+# ==================== filters_count_query ====================
+#
+def filters_count_query(clauses):
+    '''Build a search body counting the documents of many clauses with one filters aggregation
+    [in] clauses: dict of query clauses keyed by name
+    '''
+    return {
+        "size": 0,
+        "track_total_hits": False,
+        "aggs": {
+            "counts": {
+                "filters": {
+                    "filters": clauses
+                }
+            }
+        }
+    }
+
+
+#
+# ==================== knn_query ====================
+#
+def knn_query(query_vector, k, num_candidates, field='vector', filter=None, source=None):
+    '''Build an approximate kNN search body
+    [in] query_vector: list of floats
+    [in] k: number of nearest neighbours to return
+    [in] num_candidates: number of candidates considered per shard
+    [in] field: name of the dense_vector field
+    [in] filter: optional query clause restricting the documents searched
+    [in] source: optional list of fields to return
+    '''
+    knn = {
+        "field": field,
+        "query_vector": query_vector,
+        "k": k,
+        "num_candidates": max(num_candidates, k)
+    }
+    if filter is not None:
+        knn['filter'] = filter
+    query_body = {"knn": knn, "size": k}
+    if source is not None:
+        query_body['_source'] = source
+    return query_body
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from fnmatch import fnmatch
+import json
+import threading
+import time
+
+
+class QueryCache:
+    '''Size-bounded LRU cache of search responses with a per-entry time to live
+    Entries are keyed on the index and the normalized query body, so bodies that only
+    differ by key order share an entry.
+    '''
+
+    def __init__(self, max_entries=1024, ttl=60.0):
+        '''
+        [in] max_entries: maximum number of cached responses, the least recently used is evicted
+        [in] ttl: seconds a response stays valid
+        '''
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(index_name, body):
+        '''Cache key of a search'''
+        return (index_name, json.dumps(body, sort_keys=True, separators=(',', ':'), default=str))
+
+    #
+    # ==================== get ====================
+    #
+    def get(self, index_name, body):
+        '''Get a cached response
+        [ret] the response, or None if it is not cached or has expired
+        '''
+        key = self.key(index_name, body)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    #
+    # ==================== put ====================
+    #
+    def put(self, index_name, body, response):
+        '''Cache a response'''
+        key = self.key(index_name, body)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    #
+    # ==================== invalidate ====================
+    #
+    def invalidate(self, index_name=None):
+        '''Drop the cached responses of searches that may read an index
+        Searches over comma-separated lists and wildcard patterns matching the index are
+        dropped too. Searches through an alias are only dropped with index_name=None.
+        [in] index_name: index that was written to. Default drops everything
+        '''
+        with self._lock:
+            if index_name is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries
+                        if any(fnmatch(index_name, pattern) for pattern in str(key[0]).split(','))]:
+                del self._entries[key]
+
+    #
+    # ==================== stats ====================
+    #
+    def stats(self):
+        '''Get the cache counters
+        [ret] dict with hits, misses, evictions, number of entries and hit rate
+        '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'hit_rate': self.hits / lookups if lookups > 0 else 0.0}
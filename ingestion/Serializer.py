@@ -0,0 +1,138 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import elasticsearch
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Name of the JSON library used by dumps and loads: orjson if installed, else json
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+def _default(obj):
+    '''Encode the values JSON has no type for'''
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if hasattr(obj, 'tolist'):
+        # numpy arrays and scalars
+        return obj.tolist()
+    raise TypeError(f'Unable to serialize {obj!r} (type: {type(obj).__name__})')
+
+
+#
+# ==================== dumps ====================
+#
+def dumps(obj, default=_default, backend=None):
+    '''Encode an object to compact UTF-8 JSON
+    [in] obj: object to encode
+    [in] default: function encoding the values JSON has no type for
+    [in] backend: 'orjson' or 'json'. Default is BACKEND
+    [ret] bytes
+    '''
+    if (backend or BACKEND) == 'orjson':
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=default, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8', 'surrogatepass')
+
+
+#
+# ==================== loads ====================
+#
+def loads(data, backend=None):
+    '''Decode JSON
+    [in] data: bytes or str
+    [in] backend: 'orjson' or 'json'. Default is BACKEND
+    '''
+    if (backend or BACKEND) == 'orjson':
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+#
+# ==================== client_kwargs ====================
+#
+def client_kwargs(backend='auto'):
+    '''Build the serializer arguments of the Elasticsearch client
+    Requests and responses, e.g. search responses with highlights, are then encoded and
+    decoded with dumps and loads. Bodies already encoded to bytes are sent as they are.
+    [in] backend: 'auto' for orjson if installed, 'orjson' or 'json'
+    [ret] dict of keyword arguments for Elasticsearch or AsyncElasticsearch
+    '''
+    if backend == 'auto':
+        backend = BACKEND
+    if backend == 'orjson' and orjson is None:
+        print('Error: orjson is not installed, using json')
+        backend = 'json'
+    if elasticsearch.__version__[0] < 8:
+        return {'serializer': _serializer_7(backend)}
+    return {'serializers': _serializers_8(backend)}
+
+
+def _serializer_7(backend):
+    from elasticsearch.serializer import JSONSerializer
+
+    class FastJSONSerializer(JSONSerializer):
+        def loads(self, s):
+            return loads(s, backend)
+
+        def dumps(self, data):
+            if isinstance(data, (str, bytes)):
+                return data
+            return dumps(data, self.default, backend).decode('utf-8', 'surrogatepass')
+
+    return FastJSONSerializer()
+
+
+def _serializers_8(backend):
+    from elasticsearch.serializer import (JsonSerializer, NdjsonSerializer, CompatibilityModeJsonSerializer,
+                                          CompatibilityModeNdjsonSerializer)
+
+    class FastJsonSerializer(JsonSerializer):
+        def loads(self, data):
+            # some responses have a JSON content type but no body
+            return loads(data, backend) if data else None
+
+        def dumps(self, data):
+            if isinstance(data, str):
+                return data.encode('utf-8', 'surrogatepass')
+            if isinstance(data, bytes):
+                return data
+            return dumps(data, self.default, backend)
+
+    class FastNdjsonSerializer(NdjsonSerializer):
+        def loads(self, data):
+            return [loads(line, backend) for line in data.splitlines() if line.strip()]
+
+        def dumps(self, data):
+            if isinstance(data, (str, bytes)):
+                data = (data,)
+            buffer = bytearray()
+            for line in data:
+                if isinstance(line, str):
+                    line = line.encode('utf-8', 'surrogatepass')
+                elif not isinstance(line, bytes):
+                    line = dumps(line, self.default, backend)
+                buffer += line
+                if not buffer.endswith(b'\n'):
+                    buffer += b'\n'
+            return bytes(buffer)
+
+    class FastCompatibilityModeJsonSerializer(FastJsonSerializer):
+        mimetype = CompatibilityModeJsonSerializer.mimetype
+
+    class FastCompatibilityModeNdjsonSerializer(FastNdjsonSerializer):
+        mimetype = CompatibilityModeNdjsonSerializer.mimetype
+
+    serializers = [FastJsonSerializer(), FastNdjsonSerializer(), FastCompatibilityModeJsonSerializer(),
+                   FastCompatibilityModeNdjsonSerializer()]
+    return {serializer.mimetype: serializer for serializer in serializers}
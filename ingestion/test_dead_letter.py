@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from BulkIngester import BulkIngester, DeadLetterFile
+from ESClient import ESClient
+import Serializer
+
+
+class StubClient(ESClient):
+    '''Client answering bulk requests locally: records flagged "bad" are rejected with a 400
+    by the index "article", and accepted by any other index'''
+
+    def bulk(self, operations=None, body=None, **kwargs):
+        lines = [Serializer.loads(line) for line in (operations or body).splitlines() if line.strip()]
+        items = []
+        for action, record in zip(lines[::2], lines[1::2]):
+            op, meta = next(iter(action.items()))
+            if meta['_index'] == 'article' and record.get('bad'):
+                items.append({op: {'status': 400, 'error': {'type': 'mapper_parsing_exception'}}})
+            else:
+                items.append({op: {'status': 201}})
+        return {'items': items}
+
+
+def test_dead_letter_replay():
+    es = StubClient(hosts='http://localhost:9200')
+    with tempfile.TemporaryDirectory() as folder:
+        dead_letter_path = os.path.join(folder, 'article.dlq.ndjson')
+        with BulkIngester(es, 'article', dead_letter_path=dead_letter_path) as ingester:
+            ingester.add({'title': 'good'}, doc_id='1')
+            ingester.add({'title': 'rejected', 'bad': True}, doc_id='2')
+        assert len(ingester.summary) == 1
+        assert ingester.summary[0]['indexed'] == 1
+        assert ingester.summary[0]['failed'] == 1
+        assert ingester.summary[0]['dead_lettered'] == 1
+
+        entries = list(DeadLetterFile(dead_letter_path))
+        assert len(entries) == 1
+        assert entries[0]['id'] == '2' and entries[0]['status'] == 400 and entries[0]['op'] == 'index'
+        assert entries[0]['doc'] == {'title': 'rejected', 'bad': True}
+
+        summaries = es.replay_dead_letters(dead_letter_path, index_name='article_fixed',
+                                           dead_letter_path=os.path.join(folder, 'replay.dlq.ndjson'))
+        assert summaries['article_fixed'][0]['indexed'] == 1
+        assert summaries['article_fixed'][0]['failed'] == 0
+
+
+def test_short_bulk_response():
+    class ShortClient(StubClient):
+        def bulk(self, operations=None, body=None, **kwargs):
+            response = StubClient.bulk(self, operations, body, **kwargs)
+            return {'items': response['items'][:1]}
+
+    es = ShortClient(hosts='http://localhost:9200')
+    with tempfile.TemporaryDirectory() as folder:
+        dead_letter_path = os.path.join(folder, 'article.dlq.ndjson')
+        with BulkIngester(es, 'article', dead_letter_path=dead_letter_path) as ingester:
+            ingester.add({'title': 'first'}, doc_id='1')
+            ingester.add({'title': 'second'}, doc_id='2')
+        assert (ingester.summary[0]['indexed'], ingester.summary[0]['failed']) == (1, 1)
+        assert [entry['id'] for entry in DeadLetterFile(dead_letter_path)] == ['2']
+
+
+if __name__ == '__main__':
+    test_dead_letter_replay()
+    test_short_bulk_response()
+    print('OK')
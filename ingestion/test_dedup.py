@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+from Dedup import DedupStage
+
+
+def _articles(count, length=200, seed=0):
+    '''Random articles over a Zipf vocabulary, like the word frequencies of news text'''
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, 20001)
+    words = rng.choice(20000, (count, length), p=weights / weights.sum())
+    return rng, words
+
+
+def _edit(rng, words, edits):
+    words = words.copy()
+    positions = rng.choice(len(words), edits, replace=False)
+    words[positions] = rng.integers(20000, size=edits)
+    return words
+
+
+def _record(url, words):
+    return {'url': url, 'title': '', 'content': ' '.join(f'w{word}' for word in words)}
+
+
+def test_near_duplicate_recall():
+    rng, originals = _articles(1500)
+    dedup = DedupStage(mode='tag', merge_size=500)
+    # unrelated articles: none is a duplicate
+    for start in range(0, len(originals), 500):
+        output = dedup([_record(f'u{i}', originals[i]) for i in range(start, start + 500)])
+        assert not any('duplicate_of' in record for record in output)
+
+    for edits, min_recall in [(1, 0.98), (2, 0.95), (5, 0.75)]:
+        copies = [_record(f'e{edits}-{i}', _edit(rng, originals[i], edits)) for i in range(0, 1500, 5)]
+        output = dedup(copies)
+        found = [record.get('duplicate_of') == f'u{i}' for record, i in zip(output, range(0, 1500, 5))]
+        assert np.mean(found) >= min_recall, (edits, np.mean(found))
+
+
+def test_exact_duplicates_and_short_records():
+    dedup = DedupStage()
+    text = ' '.join(f'w{i}' for i in range(50))
+    output = dedup([{'url': 'u1', 'content': text}, {'url': 'u2', 'content': text.upper()},
+                    {'url': 'u3', 'title': '', 'content': ''}, {'url': 'u4', 'title': '', 'content': ''},
+                    {'url': 'u5', 'title': 'Weather'}, {'url': 'u6', 'title': 'Weather'}])
+    assert [record['url'] for record in output] == ['u1', 'u3', 'u4', 'u5', 'u6']
+    stats = dedup.stats()
+    assert (stats['exact'], stats['skipped'], stats['unique']) == (1, 4, 1)
+
+
+def test_merge_and_save_load():
+    rng, originals = _articles(20, seed=1)
+    dedup = DedupStage(mode='merge')
+    output = dedup([_record('u0', originals[0]), _record('u1', originals[1]),
+                    _record('copy', _edit(rng, originals[0], 2))])
+    assert [record['url'] for record in output] == [['u0', 'copy'], 'u1']
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'article.dedup.npz')
+        dedup.save(path)
+        loaded = DedupStage(mode='tag').load(path)
+    output = loaded([_record('again', _edit(rng, originals[1], 1)), _record('u2', originals[2])])
+    assert output[0]['duplicate_of'] == 'u1'
+    assert 'duplicate_of' not in output[1]
+
+
+if __name__ == '__main__':
+    test_near_duplicate_recall()
+    test_exact_duplicates_and_short_records()
+    test_merge_and_save_load()
+    print('OK')
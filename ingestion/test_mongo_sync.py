@@ -0,0 +1,130 @@
+import datetime
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mongomock
+
+from BulkIngester import DeadLetterFile
+from MongoSync import MongoSync
+import Serializer
+
+
+class StubClient:
+    '''Bulk client keeping the index in a dict. Ids in reject are refused with a 400'''
+
+    def __init__(self):
+        self.docs = {}
+        self.reject = set()
+
+    def bulk(self, operations=None, body=None, **kwargs):
+        lines = [Serializer.loads(line) for line in (operations or body).splitlines() if line.strip()]
+        items = []
+        i = 0
+        while i < len(lines):
+            op, meta = next(iter(lines[i].items()))
+            i += 1
+            if meta['_id'] in self.reject:
+                items.append({op: {'status': 400, 'error': {'type': 'mapper_parsing_exception'}}})
+            elif op == 'delete':
+                items.append({op: {'status': 200 if self.docs.pop(meta['_id'], None) else 404}})
+            else:
+                self.docs[meta['_id']] = lines[i]
+                items.append({op: {'status': 201}})
+            if op != 'delete':
+                i += 1
+        return {'items': items}
+
+
+def _time(minute):
+    return datetime.datetime(2024, 1, 1, 12, minute)
+
+
+def _sync(collection, es, checkpoint_path, **options):
+    return MongoSync(collection, es, 'article', checkpoint_path, deleted_field='deleted', batch_size=2,
+                     max_retries=0, **options).run()
+
+
+def test_watermark_sync():
+    collection = mongomock.MongoClient()['news']['article']
+    es = StubClient()
+    with tempfile.TemporaryDirectory() as folder:
+        checkpoint_path = os.path.join(folder, 'article.sync.json')
+
+        # first sync, in batches of 2 with ties on updated_at
+        collection.insert_many([{'_id': name, 'title': name, 'updated_at': _time(1)} for name in 'abc'])
+        stats = _sync(collection, es, checkpoint_path)
+        assert sorted(es.docs) == ['a', 'b', 'c']
+        assert (stats['batches'], stats['upserted'], stats['failed']) == (2, 3, 0)
+        assert stats['checkpoint'] == {'updated_at': _time(1), '_id': 'c'}
+
+        # incremental: an update in the same instant as the watermark, a later one and a soft delete
+        collection.insert_one({'_id': 'd', 'title': 'd', 'updated_at': _time(1)})
+        collection.update_one({'_id': 'a'}, {'$set': {'title': 'a2', 'updated_at': _time(2)}})
+        collection.update_one({'_id': 'b'}, {'$set': {'deleted': True, 'updated_at': _time(3)}})
+        stats = _sync(collection, es, checkpoint_path)
+        assert sorted(es.docs) == ['a', 'c', 'd']
+        assert es.docs['a']['title'] == 'a2'
+        assert (stats['upserted'], stats['deleted']) == (2, 1)
+
+        # nothing changed
+        stats = _sync(collection, es, checkpoint_path)
+        assert (stats['batches'], stats['upserted'], stats['deleted']) == (0, 0, 0)
+
+
+def test_resume_after_failed_batch():
+    collection = mongomock.MongoClient()['news']['article']
+    es = StubClient()
+    with tempfile.TemporaryDirectory() as folder:
+        checkpoint_path = os.path.join(folder, 'article.sync.json')
+        collection.insert_many([{'_id': name, 'title': name, 'updated_at': _time(i)}
+                                for i, name in enumerate('abcd')])
+        es.reject = {'c'}
+        # without a dead-letter file, the failed document is read again on the next run
+        stats = _sync(collection, es, checkpoint_path, dead_letter_path=None)
+        assert (stats['upserted'], stats['failed']) == (3, 1)
+        # the failed batch is not checkpointed
+        assert stats['checkpoint'] == {'updated_at': _time(1), '_id': 'b'}
+        assert 'c' not in es.docs
+
+        es.reject = set()
+        stats = _sync(collection, es, checkpoint_path)
+        assert (stats['upserted'], stats['failed']) == (2, 0)
+        assert sorted(es.docs) == ['a', 'b', 'c', 'd']
+
+        # with one, the sync goes on past it
+        collection.insert_many([{'_id': name, 'title': name, 'updated_at': _time(10 + i)}
+                                for i, name in enumerate('efg')])
+        es.reject = {'e'}
+        dead_letter_path = os.path.join(folder, 'article.dead_letter.ndjson')
+        stats = _sync(collection, es, checkpoint_path, dead_letter_path=dead_letter_path)
+        assert (stats['upserted'], stats['failed']) == (2, 1)
+        assert stats['checkpoint']['_id'] == 'g'
+        assert [entry['id'] for entry in DeadLetterFile(dead_letter_path)] == ['e']
+
+
+def test_missing_updated_at():
+    collection = mongomock.MongoClient()['news']['article']
+    es = StubClient()
+    with tempfile.TemporaryDirectory() as folder:
+        checkpoint_path = os.path.join(folder, 'article.sync.json')
+        collection.insert_many([{'_id': 'a', 'title': 'a'}, {'_id': 'b', 'title': 'b', 'updated_at': None}])
+        stats = _sync(collection, es, checkpoint_path)
+        assert stats['upserted'] == 0
+        assert stats['checkpoint'] == {}
+
+        collection.insert_many([{'_id': name, 'title': name, 'updated_at': _time(1)} for name in 'cd'])
+        _sync(collection, es, checkpoint_path)
+        collection.insert_one({'_id': 'e', 'title': 'e', 'updated_at': _time(2)})
+        _sync(collection, es, checkpoint_path)
+        assert sorted(es.docs) == ['c', 'd', 'e']
+        assert _sync(collection, es, checkpoint_path)['checkpoint']['updated_at'] == _time(2)
+
+
+if __name__ == '__main__':
+    test_watermark_sync()
+    test_resume_after_failed_batch()
+    test_missing_updated_at()
+    print('OK')